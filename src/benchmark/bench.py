@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""End to end benchmark of NamespaceTopology against the synthetic Turbonomic stand-in
+
+Starts a StandinServer for a generated topology and runs the report once per scenario, each in
+its own process so peak RSS is measured per scenario.  A scenario is a comma separated list of
+NamespaceTopology keyword arguments, e.g. ``fetch_workers=8,stats_batch_size=50``.  Arguments
+prefixed with ``limiter_`` (e.g. ``limiter_rate=20``) are passed to a RateLimiter and those
+prefixed with ``pager_`` (e.g. ``pager_adaptive=1``) to a PageSizer wrapping the connection.
+
+For every scenario the wall time, API call count, bytes transferred and peak RSS are recorded,
+printed as a table and optionally written as JSON to track results between releases.
+
+Usage:
+    python src/benchmark/bench.py --namespaces 2000 --latency 0.02 \\
+        --scenario fetch_workers=1 --scenario fetch_workers=8,stats_batch_size=50 --output bench.json
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+import warnings
+
+from turbo_standin import StandinServer, SyntheticTopology
+
+DEFAULT_SCENARIOS = ['fetch_workers=1', 'fetch_workers=8', 'fetch_workers=8,stats_batch_size=50']
+
+
+def parse_scenario(scenario):
+    """Parse 'key=value,key=value' into NamespaceTopology kwargs"""
+    kwargs = {}
+    for item in filter(None, scenario.split(',')):
+        key, value = item.split('=', 1)
+        try:
+            kwargs[key] = int(value)
+        except ValueError:
+            kwargs[key] = value.split(':') if ':' in value else value
+    return kwargs
+
+
+def run_scenario(host, kwargs, results):
+    """Run one report in a child process and put its measurements on the results queue"""
+    os.environ.setdefault('LOGLEVEL', 'WARNING')
+    warnings.simplefilter('ignore')
+
+    import vmtconnect as vc
+    from nsutil import load_namespace_util
+
+    nsu = load_namespace_util()
+    conn = vc.Connection(host=host, username='standin', password='standin', ssl=False)
+    pager_kwargs = {key[len('pager_'):]: kwargs.pop(key) for key in list(kwargs) if key.startswith('pager_')}
+    if pager_kwargs:
+        if 'sizes' in pager_kwargs:
+            sizes = pager_kwargs['sizes']
+            pager_kwargs['sizes'] = nsu.PageSizer.parse_sizes(':'.join(sizes) if isinstance(sizes, list) else str(sizes))
+        nsu.PageSizer(**pager_kwargs).wrap(conn)
+    limiter_kwargs = {key[len('limiter_'):]: kwargs.pop(key) for key in list(kwargs) if key.startswith('limiter_')}
+    if limiter_kwargs:
+        nsu.RateLimiter(**limiter_kwargs).wrap(conn)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'namespaceReport.csv')
+        start = time.perf_counter()
+        topology = nsu.NamespaceTopology(conn, **kwargs)
+        topology.output_to_csv(filename)
+        wall_time = time.perf_counter() - start
+        with open(filename) as report:
+            rows = sum(1 for _ in report) - 1
+
+    results.put({'wall_time': wall_time,
+                 'rows': rows,
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NamespaceTopology end to end benchmark')
+    parser.add_argument('--clusters', type=int, default=5)
+    parser.add_argument('--nodes', type=int, default=10, help='nodes per cluster')
+    parser.add_argument('--namespaces', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30, help='days of history per namespace')
+    parser.add_argument('--page-size', type=int, default=100, help='server default page size')
+    parser.add_argument('--max-page-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every request')
+    parser.add_argument('--latency-per-item', type=float, default=0.0, help='seconds added per returned record')
+    parser.add_argument('--max-concurrency', type=int, help='stand-in returns 429 beyond this many requests in flight')
+    parser.add_argument('--scenario', action='append', help='NamespaceTopology kwargs, may be repeated')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    topology = SyntheticTopology(args.clusters, args.nodes, args.namespaces, args.days)
+    server = StandinServer(topology, page_size=args.page_size, max_page_size=args.max_page_size,
+                           latency=args.latency, latency_per_item=args.latency_per_item,
+                           max_concurrency=args.max_concurrency).start()
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    try:
+        for scenario in args.scenario or DEFAULT_SCENARIOS:
+            queue = context.Queue()
+            server.reset_counters()
+            process = context.Process(target=run_scenario, args=(server.host, parse_scenario(scenario), queue))
+            process.start()
+            process.join()
+
+            if process.exitcode != 0:
+                results.append({'scenario': scenario, 'error': f'exit code {process.exitcode}'})
+                continue
+
+            result = {'scenario': scenario, **queue.get()}
+            result.update({'api_calls': server.counters['requests'],
+                           'throttled': server.counters['throttled'],
+                           'bytes_in': server.counters['bytes_in'],
+                           'bytes_out': server.counters['bytes_out'],
+                           'endpoints': dict(server.counters['endpoints'])})
+            results.append(result)
+    finally:
+        server.stop()
+
+    print(f"Topology: {args.clusters} clusters x {args.nodes} nodes, {args.namespaces} namespaces, {args.days} days, "
+          f"page size {args.page_size}, latency {args.latency}s")
+    print(f"{'Scenario':<45}{'Rows':>7}{'Wall (s)':>10}{'API calls':>11}{'Throttled':>11}{'MB out':>9}{'Peak RSS (MB)':>15}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['scenario']:<45} failed: {result['error']}")
+            continue
+        print(f"{result['scenario']:<45}{result['rows']:>7}{result['wall_time']:>10.2f}{result['api_calls']:>11}{result['throttled']:>11}"
+              f"{result['bytes_out'] / 1024 / 1024:>9.2f}{result['peak_rss_mb']:>15.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(),
+                       'topology': {k: v for k, v in vars(args).items() if k not in ('scenario', 'output')},
+                       'results': results}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Memory report comparing namespace/cluster record models for a synthetic topology
+
+Builds the same synthetic topology twice, once with the previous dict based model (a stats
+DTO and nested stats dicts per namespace, plus a copy of the master node list per cluster) and
+once with the slotted NamepaceEntity/CommodityStats/ClusterNodes records, and reports the memory
+traced for each.  Both models hold the same reported tags and the same stats fields, so the
+comparison measures the record model only.  The saving from keeping only the reported tags is
+measured separately, with the slotted model holding every tag.  Each build parses the search
+response itself, so tags a record keeps from the response are counted.
+
+Usage:
+    python src/benchmark/memory_report.py --namespaces 50000
+"""
+import argparse
+import gc
+import json
+import tracemalloc
+
+import numpy as np
+
+from nsutil import load_namespace_util
+
+
+class LegacyNamespace():
+    """Dict based namespace record as kept before the slotted model"""
+
+    def __init__(self, conn, namespace, startDate, endDate, commodities, stats, tags=None):
+        self._conn = conn
+        self._uuid = namespace['uuid']
+        self.name = namespace['displayName']
+        self.tags = {key: value for key, value in namespace.get('tags', {}).items() if tags is None or key in tags}
+        self.cluster_uuid, self.cluster = namespace['providers'][0]['uuid'], namespace['providers'][0]['displayName']
+        self._startDate = startDate
+        self._endDate = endDate
+        self._namespace_stats_dto = {'statistics': [{'name': x, 'relatedEntityType': 'Namespace'} for x in commodities],
+                                     'startDate': startDate, 'endDate': endDate}
+        self.stats = {name: values.to_dict() for name, values in stats.items()}
+
+
+class LegacyCluster():
+    """Cluster record holding its own copy of the master node list"""
+
+    def __init__(self, cluster, master_nodes):
+        self._uuid = cluster['uuid']
+        self.name = cluster['displayName']
+        self._master_nodes = list(master_nodes)
+        self.numCores, self.total_mhz = 0, 0.0
+
+
+def synthetic_topology(namespaces, clusters, tags, master_nodes):
+    """Generate search results for a synthetic topology, with the namespaces as a JSON response body"""
+    cluster_list = [{'uuid': f'cluster-{i:06d}', 'displayName': f'cluster{i}'} for i in range(clusters)]
+    namespace_list = []
+
+    for i in range(namespaces):
+        cluster = cluster_list[i % clusters]
+        namespace_list.append({'uuid': f'{i:032x}',
+                               'displayName': f'namespace-{i}',
+                               'className': 'Namespace',
+                               'tags': {f'tag{t}': [f'value-{i % 7}-{t}'] for t in range(tags)},
+                               'providers': [{'className': 'ContainerPlatformCluster', **cluster}]})
+
+    masters = [f'master-{i:06d}' for i in range(master_nodes)]
+    return cluster_list, json.dumps(namespace_list), masters
+
+
+def measure(build):
+    """Return the bytes traced while building and holding the result of build()"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--namespaces', type=int, default=50000)
+    parser.add_argument('--clusters', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=5, help='tags per namespace')
+    parser.add_argument('--report-tags', type=int, default=2, help='tags requested in the report')
+    parser.add_argument('--master-nodes', type=int, default=300)
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    nsu = load_namespace_util()
+    commodities = ['VCPU', 'VCPURequestQuota', 'VCPULimitQuota', 'VMem', 'VMemRequestQuota', 'VMemLimitQuota']
+    start_date, end_date = '2026-09-01T00:00:00Z', '2026-09-30T00:00:00Z'
+    report_tags = [f'tag{t}' for t in range(args.report_tags)]
+    cluster_list, namespace_body, masters = synthetic_topology(args.namespaces, args.clusters, args.tags, args.master_nodes)
+
+    rng = np.random.default_rng(0)
+    samples = rng.random((len(commodities), args.days)) * 1000
+    stats = {commodity: nsu.NamepaceEntity.summarize_samples(samples[i], samples[i] * 1.5, 1000000000000.0)
+             for i, commodity in enumerate(commodities)}
+
+    def build_legacy():
+        return ([LegacyNamespace(None, ns, start_date, end_date, commodities, stats, tags=report_tags) for ns in json.loads(namespace_body)],
+                [LegacyCluster(cluster, masters) for cluster in cluster_list])
+
+    def build_compact(report_tags=report_tags):
+        stats_dto = nsu.NamepaceEntity._set_stats_dto(start_date, end_date, commodities)
+        master_set = set(masters)
+        entities = []
+        for ns in json.loads(namespace_body):
+            entity = nsu.NamepaceEntity(None, ns, start_date, end_date, commodities, fetch_stats=False, tags=report_tags, stats_dto=stats_dto)
+            entity.stats = {name: nsu.CommodityStats(**values.to_dict()) for name, values in stats.items()}
+            entities.append(entity)
+        return (entities, master_set,
+                [nsu.ClusterNodes(cluster, nodes_info=[0, 0.0]) for cluster in cluster_list])
+
+    legacy = measure(build_legacy)
+    compact = measure(build_compact)
+    all_tags = measure(lambda: build_compact(None))
+
+    print(f"Synthetic topology: {args.namespaces} namespaces, {args.clusters} clusters, "
+          f"{args.tags} tags per namespace ({args.report_tags} reported), {args.master_nodes} master nodes")
+    print(f"{'Model':<10}{'Memory (MB)':>14}{'Bytes/namespace':>18}")
+    for name, size in (('dict', legacy), ('slotted', compact)):
+        print(f"{name:<10}{size / 1024 / 1024:>14.1f}{size / args.namespaces:>18.0f}")
+    print(f"Reduction: {(1 - compact / legacy) * 100:.1f}%")
+    print(f"Keeping {args.report_tags} of {args.tags} tags: {all_tags / 1024 / 1024:.1f} MB -> {compact / 1024 / 1024:.1f} MB "
+          f"({(1 - compact / all_tags) * 100:.1f}% reduction, slotted model)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""Helpers shared by the benchmark tools"""
+import importlib.util
+import os
+import sys
+
+SRC_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')
+
+
+def load_namespace_util():
+    """Import namespace-util.py, which cannot be imported by name because of the hyphen"""
+    if 'namespace_util' in sys.modules:
+        return sys.modules['namespace_util']
+
+    sys.path.insert(0, SRC_PYTHON)
+    spec = importlib.util.spec_from_file_location('namespace_util', os.path.join(SRC_PYTHON, 'namespace-util.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['namespace_util'] = module
+    spec.loader.exec_module(module)
+    return module
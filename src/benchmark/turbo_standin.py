@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""Synthetic Turbonomic API stand-in for offline benchmarking
+
+Serves the subset of the Turbonomic v3 REST API used by namespace-util.py (login, versions,
+markets, search, supplychains and stats) for a generated topology, with cursor paging in the
+shape the vmtconnect Pager expects (``cursor``/``limit`` query parameters and the
+``x-next-cursor``/``x-total-record-count`` headers).  Historical stats are generated on demand
+from a seeded RNG, so large topologies do not need to be held in memory.
+
+Usage:
+    python src/benchmark/turbo_standin.py --port 8080 --namespaces 5000 --latency 0.05
+
+Then connect with ``vc.Connection(host='127.0.0.1:8080', username='x', password='x', ssl=False)``.
+"""
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_BASE = '/api/v3/'
+MARKET_UUID = '777777'
+VERSION_INFO = {'versionInfo': 'Turbonomic Operations Manager 8.9.0 (Build "20260101000000") "2026-01-01 00:00:00"\n\n'
+                               'action-orchestrator: 8.9.0\n',
+                'version': '8.9.0',
+                'build': '20260101000000',
+                'branch': '8.9.0',
+                'marketVersion': 2}
+COMMODITIES = ['VCPU', 'VCPURequestQuota', 'VCPULimitQuota', 'VMem', 'VMemRequestQuota', 'VMemLimitQuota']
+SYSTEM_PREFIXES = ['kube-', 'openshift-']
+
+
+class SyntheticTopology():
+    """Generated clusters, nodes and namespaces with deterministic historical stats
+
+    The last no_data namespaces have no history, like namespaces created after the report period.
+    """
+
+    def __init__(self, clusters=5, nodes=10, namespaces=500, days=30, system_namespaces=0.2, seed=0, no_data=0):
+        self.days = days
+        self.seed = seed
+        self.clusters = [{'uuid': f'cluster-{c:05d}', 'displayName': f'cluster-{c}', 'className': 'ContainerPlatformCluster'}
+                         for c in range(clusters)]
+        self.nodes = {}
+        self.groups = []
+        self.namespaces = []
+        rng = random.Random(seed)
+
+        for c, cluster in enumerate(self.clusters):
+            cluster_nodes = []
+            for n in range(nodes):
+                cores = rng.choice([4, 8, 16])
+                cluster_nodes.append({'uuid': f'vm-{c:05d}-{n:04d}',
+                                      'displayName': f'{cluster["displayName"]}-node-{n}',
+                                      'className': 'VirtualMachine',
+                                      'state': 'ACTIVE' if rng.random() > 0.05 else 'SUSPEND',
+                                      'numVCPUs': cores,
+                                      'mhz': cores * 2600.0})
+            self.nodes[cluster['uuid']] = cluster_nodes
+            masters = [node['uuid'] for node in cluster_nodes[:min(3, len(cluster_nodes) // 3)]]
+            self.groups.append({'uuid': f'group-master-{c:05d}',
+                                'displayName': f'NodeRole-master-{cluster["displayName"]}',
+                                'className': 'Group',
+                                'memberUuidList': masters})
+
+        for i in range(namespaces):
+            cluster = self.clusters[i % clusters]
+            if rng.random() < system_namespaces:
+                name = f'{rng.choice(SYSTEM_PREFIXES)}system-{i}'
+            else:
+                name = f'app-{i}'
+            self.namespaces.append({'uuid': f'{zlib.crc32(f"{seed}-{i}".encode()):08x}{i:024x}',
+                                    'displayName': name,
+                                    'className': 'Namespace',
+                                    'environmentType': 'HYBRID',
+                                    'tags': {'team': [f'team-{i % 17}'], 'cost-center': [f'cc-{i % 5}']},
+                                    'providers': [{'uuid': cluster['uuid'],
+                                                   'displayName': cluster['displayName'],
+                                                   'className': 'ContainerPlatformCluster'}]})
+
+        self.namespace_index = {ns['uuid']: ns for ns in self.namespaces}
+        self.no_data = {ns['uuid'] for ns in self.namespaces[len(self.namespaces) - no_data:]} if no_data else set()
+        self.node_index = {node['uuid']: node for nodes in self.nodes.values() for node in nodes}
+
+    def history(self, uuid, start, end, commodities, ascending=True):
+        """Return HISTORICAL stat snapshots for a namespace, one per day between start and end, oldest first if ascending"""
+        snapshots = []
+        day = end
+
+        if uuid in self.no_data:
+            return snapshots
+
+        for _ in range(self.days):
+            if day < start:
+                break
+            rng = random.Random(f'{self.seed}-{uuid}-{day.isoformat()}')
+            statistics = []
+            for commodity in commodities:
+                capacity = 1000000000000.0 if 'Limit' in commodity and rng.random() < 0.5 else rng.uniform(2000, 64000)
+                avg = rng.uniform(0, capacity if capacity < 1000000000000.0 else 64000) * 0.3
+                statistics.append({'name': commodity,
+                                   'capacity': {'max': capacity, 'min': capacity, 'avg': capacity, 'total': capacity},
+                                   'filters': [{'type': 'relation', 'value': 'sold'}],
+                                   'relatedEntityType': 'Namespace',
+                                   'units': 'MHz' if 'VCPU' in commodity else 'KB',
+                                   'values': {'max': avg * rng.uniform(1, 2.5), 'min': avg * 0.5, 'avg': avg, 'total': avg}})
+            snapshots.append({'date': day.strftime('%Y-%m-%dT%H:%M:%SZ'), 'epoch': 'HISTORICAL', 'statistics': statistics})
+            day -= datetime.timedelta(days=1)
+
+        return snapshots[::-1] if ascending else snapshots
+
+
+class StandinServer():
+    """Threaded HTTP server serving a SyntheticTopology, with request and byte counters"""
+
+    def __init__(self, topology, host='127.0.0.1', port=0, page_size=100, max_page_size=500, latency=0.0, latency_per_item=0.0,
+                 max_concurrency=None):
+        self.topology = topology
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.max_concurrency = max_concurrency
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.reset_counters()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return f'{self._httpd.server_address[0]}:{self._httpd.server_address[1]}'
+
+    def reset_counters(self):
+        with self._lock:
+            self.counters = {'requests': 0, 'throttled': 0, 'bytes_in': 0, 'bytes_out': 0, 'endpoints': {}}
+
+    def _count(self, endpoint, bytes_in, bytes_out):
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['bytes_in'] += bytes_in
+            self.counters['bytes_out'] += bytes_out
+            self.counters['endpoints'][endpoint] = self.counters['endpoints'].get(endpoint, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, without TCP_NODELAY every response waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def _dispatch(self, method):
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+
+                if url.path == '/standin/counters':
+                    return self._send(json.dumps(server.counters).encode(), 'standin')
+
+                if not url.path.startswith(API_BASE):
+                    return self._send(b'{"message": "not found"}', 'unknown', status=404)
+
+                resource = url.path[len(API_BASE):].strip('/')
+                endpoint = f'{method} {resource.split("/")[0]}'
+
+                # reject requests beyond max_concurrency like an overloaded API server
+                with server._lock:
+                    throttled = server.max_concurrency and server._in_flight >= server.max_concurrency
+                    if throttled:
+                        server.counters['throttled'] += 1
+                    else:
+                        server._in_flight += 1
+
+                if throttled:
+                    return self._send(b'{"message": "too many requests"}', endpoint, 429, bytes_in=len(body))
+
+                try:
+                    try:
+                        status, result, headers, items = server.route(method, resource, query, body)
+                    except Exception as e:
+                        status, result, headers, items = 400, {'message': str(e)}, {}, 0
+
+                    delay = server.latency + server.latency_per_item * items
+                    if delay:
+                        time.sleep(delay)
+                finally:
+                    with server._lock:
+                        server._in_flight -= 1
+
+                self._send(json.dumps(result).encode(), endpoint, status, headers, len(body))
+
+            def _send(self, data, endpoint, status=200, headers=None, bytes_in=0):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+                server._count(endpoint, bytes_in, len(data))
+
+        return Handler
+
+    def _page(self, items, query):
+        """Return a page of items and the paging headers for the request's cursor and limit"""
+        cursor = int(query.get('cursor', 0) or 0)
+        limit = min(int(query.get('limit', self.page_size) or self.page_size), self.max_page_size)
+        page = items[cursor:cursor + limit]
+        headers = {'x-total-record-count': str(len(items))}
+
+        if cursor + limit < len(items):
+            headers['x-next-cursor'] = str(cursor + limit)
+
+        return page, headers
+
+    def route(self, method, resource, query, body):
+        """Return (status, result, headers, item count) for an API request"""
+        dto = json.loads(body) if body and method == 'POST' and resource != 'login' else {}
+        topology = self.topology
+
+        if resource == 'login':
+            return 200, {'username': 'standin', 'uuid': '1'}, {'Set-Cookie': 'JSESSIONID=standin; Path=/'}, 0
+
+        if resource == 'admin/versions':
+            return 200, VERSION_INFO, {}, 0
+
+        if resource == 'markets':
+            return 200, [{'uuid': MARKET_UUID, 'displayName': 'Market', 'className': 'Market'}], {}, 0
+
+        if resource.startswith('markets/'):
+            return 200, {'uuid': MARKET_UUID, 'displayName': 'Market', 'className': 'Market'}, {}, 0
+
+        if resource == 'search':
+            if method == 'GET':
+                types = query.get('types', '').split(',')
+                items = topology.namespaces if 'Namespace' in types else []
+            else:
+                items = self._search(dto)
+            page, headers = self._page(items, query)
+            return 200, page, headers, len(page)
+
+        if resource == 'supplychains':
+            nodes = topology.nodes.get(query.get('uuids'), [])
+            instances = {node['uuid']: {'uuid': node['uuid'],
+                                        'displayName': node['displayName'],
+                                        'className': 'VirtualMachine',
+                                        'state': node['state'],
+                                        'aspects': {'virtualMachineAspect': {'numVCPUs': node['numVCPUs']}}}
+                         for node in nodes}
+            return 200, [{'seMap': {'VirtualMachine': {'instances': instances}}}], {}, len(instances)
+
+        if resource.startswith('stats/'):
+            uuid = resource.split('/', 1)[1]
+            start, end, commodities = self._period(dto)
+            items = topology.history(uuid, start, end, commodities, self._ascending(query)) if uuid in topology.namespace_index else []
+            page, headers = self._page(items, query)
+            return 200, page, headers, len(page)
+
+        if resource == 'stats':
+            items = self._scoped_stats(dto, self._ascending(query))
+            page, headers = self._page(items, query)
+            return 200, page, headers, sum(len(x['stats']) for x in page)
+
+        return 404, {'message': f'Unknown resource {resource}'}, {}, 0
+
+    def _search(self, dto):
+        topology = self.topology
+        items = {'Namespace': topology.namespaces,
+                 'Group': topology.groups,
+                 'ContainerPlatformCluster': topology.clusters}.get(dto.get('className'), [])
+
+        for criteria in dto.get('criteriaList', []):
+            flags = 0 if criteria.get('caseSensitive') else re.IGNORECASE
+            pattern = re.compile(criteria['expVal'], flags)
+            if criteria['expType'] in ('RXEQ', 'EQ'):
+                items = [x for x in items if pattern.fullmatch(x['displayName'])]
+            elif criteria['expType'] in ('RXNEQ', 'NEQ'):
+                items = [x for x in items if not pattern.fullmatch(x['displayName'])]
+
+        return items
+
+    @staticmethod
+    def _period(dto):
+        period = dto.get('period', dto)
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        start = datetime.datetime.strptime(period['startDate'], '%Y-%m-%dT%H:%M:%SZ') if period.get('startDate') else today
+        end = datetime.datetime.strptime(period['endDate'], '%Y-%m-%dT%H:%M:%SZ') if period.get('endDate') else today
+        commodities = [stat['name'] for stat in period.get('statistics', [])] or COMMODITIES
+        return start, end.replace(hour=0, minute=0, second=0), commodities
+
+    @staticmethod
+    def _ascending(query):
+        """Return the sample order of a stats request, oldest first unless ascending=false like Turbonomic"""
+        return query.get('ascending', 'true').lower() != 'false'
+
+    def _scoped_stats(self, dto, ascending=True):
+        topology = self.topology
+
+        if dto.get('relatedType') == 'VirtualMachine':
+            entries = []
+            for scope in dto.get('scopes', []):
+                for node in topology.nodes.get(scope, []):
+                    entries.append({'uuid': node['uuid'],
+                                    'displayName': node['displayName'],
+                                    'className': 'VirtualMachine',
+                                    'stats': [{'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                               'statistics': [{'name': 'VCPU',
+                                                               'capacity': {'total': node['mhz']},
+                                                               'values': {'avg': node['mhz'] * 0.4, 'max': node['mhz'] * 0.8}}]}]})
+            return entries
+
+        start, end, commodities = self._period(dto)
+        return [{'uuid': uuid,
+                 'displayName': topology.namespace_index[uuid]['displayName'],
+                 'className': 'Namespace',
+                 'stats': topology.history(uuid, start, end, commodities, ascending)}
+                for uuid in dto.get('scopes', []) if uuid in topology.namespace_index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic Turbonomic API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clusters', type=int, default=5)
+    parser.add_argument('--nodes', type=int, default=10, help='nodes per cluster')
+    parser.add_argument('--namespaces', type=int, default=500)
+    parser.add_argument('--days', type=int, default=30, help='days of history per namespace')
+    parser.add_argument('--page-size', type=int, default=100, help='default page size when no limit is requested')
+    parser.add_argument('--max-page-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--latency-per-item', type=float, default=0.0, help='seconds added per returned record')
+    parser.add_argument('--max-concurrency', type=int, help='return 429 for requests beyond this many in flight')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-data', type=int, default=0, help='namespaces, the last ones, without history')
+    args = parser.parse_args()
+
+    topology = SyntheticTopology(args.clusters, args.nodes, args.namespaces, args.days, seed=args.seed, no_data=args.no_data)
+    server = StandinServer(topology, args.host, args.port, args.page_size, args.max_page_size, args.latency, args.latency_per_item,
+                           args.max_concurrency)
+    print(f'Serving {args.namespaces} namespaces on http://{server.host}{API_BASE}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,49 @@
 #!/usr/bin/env python3
 import sys
+import copy
 import datetime
 import csv
+import gzip
+import hashlib
+import heapq
 import os
 import json
 import logging
+import math
+import multiprocessing
+import queue
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 from urllib3 import disable_warnings, exceptions
+import numpy as np
 import openpyxl
 import umsg
 import vmtconnect as vc
 from sendmail import sendmail
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
 # Disable SSL/TLS warnings for API calls
 disable_warnings(exceptions.InsecureRequestWarning)
 
@@ -22,16 +55,41 @@ umsg.init(msg_format='%(asctime)s - %(levelname)s:  %(message)s',
 
 umsg.add_handler(logging.StreamHandler())
 
+# Metrics which can be requested through METRICS
+SUPPORTED_METRICS = ['average', 'peak', 'capacity', 'sum', 'median', 'p50', 'p95', 'p99', 'stddev']
+
+# Capacity Turbonomic reports for namespaces without a quota, reported as empty
+UNLIMITED_CAPACITY = 1000000000000.0
+
 
 class NamespaceTopology():
     """Class to represent all of the Namespaces in a Topology
 
     """
+    # Namespaces held back in search order while their cluster capacity is resolved
+    REORDER_LIMIT = 1000
+
     def __init__(self, conn, commodities=None, metrics=None, tags=None, **kwargs):
         self._conn = conn
         self.commodities = commodities if commodities else ['VCPU', 'VCPURequestQuota', 'VCPULimitQuota', 'VMem', 'VMemRequestQuota', 'VMemLimitQuota']
         self.metrics = [x.lower() for x in (metrics if metrics else ['average', 'peak', 'capacity', 'sum'])]
-        self._startDate,self._endDate = NamespaceTopology.get_start_end_last_month()
+
+        if any(metric not in SUPPORTED_METRICS for metric in self.metrics):
+            umsg.log(f"Ignoring unsupported metric(s): {[x for x in self.metrics if x not in SUPPORTED_METRICS]}", level=logging.ERROR)
+            self.metrics = [x for x in self.metrics if x in SUPPORTED_METRICS]
+        self.windows = kwargs['windows'] if kwargs.get('windows') else None
+        if self.windows:
+            # Stats are fetched once for the union of the windows and summarized per window
+            self._startDate = f"{min(window.start for window in self.windows).isoformat()}T00:00:00Z"
+            self._endDate = f"{max(window.end for window in self.windows).isoformat()}T23:59:59Z"
+            self._window_days = [(window.start.toordinal(), window.end.toordinal()) for window in self.windows]
+            umsg.log(f"Pulling data between {self._startDate} and {self._endDate} for report windows {self.windows}", level=logging.INFO)
+        elif kwargs.get('start_date') and kwargs.get('end_date'):
+            self._startDate,self._endDate = kwargs['start_date'], kwargs['end_date']
+        else:
+            self._startDate,self._endDate = NamespaceTopology.get_start_end_last_month()
+        if not self.windows:
+            self._window_days = None
 
         if 'excluded_namespaces'in kwargs:
             if kwargs['excluded_namespaces']:
@@ -40,13 +98,27 @@ class NamespaceTopology():
                 self._exclude_namespaces = []
         else:
             self._exclude_namespaces = ['default', 'kube', 'openshift']
-        
-        self._namespaces = self._get_namespaces()
+
+        self._exclude_criteria, self._exclude_matcher = self._set_exclude_filters(self._exclude_namespaces)
+        self._fetch_workers = kwargs['fetch_workers'] if kwargs.get('fetch_workers') else 1
+        self._stats_batch_size = kwargs['stats_batch_size'] if kwargs.get('stats_batch_size') else 1
+        self._thread_local = threading.local()
+        self._cache = kwargs['cache'] if 'cache' in kwargs else None
+        self._aggregate_store = kwargs['aggregate_store'] if 'aggregate_store' in kwargs else None
+        self._history = kwargs['history'] if kwargs.get('history') else None
+        self._delta_metrics = [x.lower() for x in kwargs['delta_metrics']] if kwargs.get('delta_metrics') else ['average']
+        self._top_growth = kwargs['top_growth'] if kwargs.get('top_growth') is not None else 20
+        self.run_metrics = kwargs['run_metrics'] if kwargs.get('run_metrics') else RunMetrics()
+        self.instance = kwargs['instance'] if kwargs.get('instance') else None
+        self._shard = (kwargs.get('shard_index', 0), kwargs['shard_count']) if kwargs.get('shard_count') else None
         self._exclude_master = kwargs['exclude_master'] if 'exclude_master'in kwargs else ['NodeRole-master', 'NodeRole-infra']
         self.tags = tags
-        self._container_clusters = ClusterTopology(self._conn, self._exclude_master)
-        self._output = []
+        self._scheduler = TaskScheduler()
+        self._container_clusters = ClusterTopology(self._conn, self._exclude_master, cache=self._cache, run_metrics=self.run_metrics,
+                                                   scheduler=self._scheduler)
+        self._namespace_stats_dto = NamepaceEntity._set_stats_dto(self._startDate, self._endDate, self.commodities)
         self._headers = []
+        self.namespaces = None
 
         # Log configuration that will be used
         umsg.log(f"Reporting using the following commodities: {self.commodities}", level=logging.INFO)
@@ -54,23 +126,287 @@ class NamespaceTopology():
         umsg.log(f"Excluding the following namespace(s): {self._exclude_namespaces}", level=logging.INFO)
         umsg.log(f"Excluding Nodes from the following group(s) defined in Turbonomic: {self._exclude_master}", level=logging.INFO)
         umsg.log(f"Including the following tag(s) in the report: {self.tags}", level=logging.INFO)
+        umsg.log(f"Fetching namespace stats using {self._fetch_workers} worker(s) and {self._stats_batch_size} namespace(s) per request", level=logging.INFO)
+        if self._shard:
+            umsg.log(f"Reporting on shard {self._shard[0]} of {self._shard[1]}", level=logging.INFO)
+
+
+    def _get_namespaces(self, namespaces=None):
+        """Generator of the namespaces to include in topology except for those excluded via self._exclude_namespaces
+
+        NamepaceEntity objects are yielded in search order as soon as their stats are retrieved,
+        with at most twice self._fetch_workers requests in flight at a time.  When an aggregate
+        store is configured the namespaces and their stats are read from it instead of the API.
+        namespaces, a list of search results, limits the namespaces fetched to those given.
+        """
+        if self._aggregate_store:
+            yield from self._get_stored_namespaces()
+            return
+
+        namespaces = self._search_namespaces() if namespaces is None else namespaces
+        if self._stats_batch_size > 1:
+            tasks = self._batch_namespaces(namespaces, self._stats_batch_size)
+            create = self._create_namespace_batch
+        else:
+            tasks = namespaces
+            create = lambda namespace: [self._create_namespace_entity(namespace)]
+
+        with ThreadPoolExecutor(max_workers=self._fetch_workers) as executor:
+            # Results are returned in search order so the output matches a serial fetch
+            if self._fetch_workers > 1:
+                results = self._bounded_map(executor, create, tasks, self._fetch_workers * 2)
+            else:
+                results = map(create, tasks)
 
+            for entities in results:
+                for entity in entities:
+                    if entity:
+                        yield entity
 
-    def _get_namespaces(self):
-        """Get all namespaces to include in topology except for those excluded via self._exclude_namespaces"""
-        search = self._conn.search(types=['Namespace'], pager=True)
-        selected_Namespaces = {}
+    def _get_stored_namespaces(self):
+        """Generator of NamepaceEntity objects built from the daily aggregates in self._aggregate_store"""
+        start_day, end_day = self._startDate[:10], self._endDate[:10]
+        days = self._aggregate_store.count_days(start_day, end_day)
+        umsg.log(f"Reporting from {days} day(s) of stored aggregates between {start_day} and {end_day}", level=logging.INFO)
+
+        for namespace in self._aggregate_store.get_namespaces(start_day, end_day):
+            if (self._exclude_matcher and self._exclude_matcher.search(namespace['displayName'])) or not self._in_shard(namespace['uuid']):
+                continue
+
+            with self.run_metrics.phase('namespace_stats'):
+                entity = NamepaceEntity(self._conn, namespace, self._startDate, self._endDate, self.commodities, fetch_stats=False, tags=self.tags, stats_dto=self._namespace_stats_dto)
+                entity.stats = self._aggregate_store.get_stats(entity.uuid, start_day, end_day)
+                if self.windows:
+                    entity.window_stats = [self._aggregate_store.get_stats(entity.uuid, window.start.isoformat(), window.end.isoformat())
+                                           for window in self.windows]
+            self._container_clusters.add_cluster(entity.cluster_uuid, entity.cluster)
+            yield entity
+
+    def store_daily_stats(self, store):
+        """Fetch the stats for the topology's day and merge them into the aggregate store"""
+        day = self._startDate[:10]
+        count = 0
+
+        # No rows are produced, so the clusters' capacity is not needed
+        for entity in self._get_namespaces(self._search_namespaces(add_clusters=False)):
+            store.add_namespace_day(entity, day)
+            count += 1
+
+        store.prune()
+        umsg.log(f"Stored {day} aggregates for {count} namespace(s)", level=logging.INFO)
+
+    def refresh(self):
+        """Bring self.namespaces up to date with Turbonomic, fetching stats only for new namespaces
+
+        Used by the service mode to keep the topology warm.  Namespaces no longer returned by the
+        search are dropped, and every namespace is fetched again once the previous month has moved
+        on.  The capacity of every cluster is resolved again into a new ClusterTopology, which
+        replaces the current one once complete.  Returns the number of namespaces fetched.
+        """
+        known = self.namespaces if self.namespaces is not None else {}
+        start_date, end_date = self.get_start_end_last_month()
+        if start_date != self._startDate:
+            self._startDate, self._endDate = start_date, end_date
+            self._namespace_stats_dto = NamepaceEntity._set_stats_dto(start_date, end_date, self.commodities)
+            known = {}
+
+        namespaces = {}
+        new_namespaces = []
+        for namespace in self._search_namespaces():
+            entity = known.get(namespace['uuid'])
+            if entity:
+                entity.name, entity.tags = namespace['displayName'], NamepaceEntity._get_tags(namespace, self.tags)
+                namespaces[entity.uuid] = entity
+            else:
+                new_namespaces.append(namespace)
+
+        for entity in self._get_namespaces(new_namespaces):
+            namespaces[entity.uuid] = entity
+
+        # The first refresh resolves capacity through the scheduler tasks added by the search
+        if self.namespaces is None:
+            container_clusters = self._container_clusters
+        else:
+            container_clusters = ClusterTopology(copy.copy(self._conn), self._exclude_master, run_metrics=self.run_metrics)
+            for entity in namespaces.values():
+                container_clusters.add_cluster(entity.cluster_uuid, entity.cluster)
+        for cluster_uuid in {entity.cluster_uuid for entity in namespaces.values() if entity.cluster_uuid}:
+            container_clusters.clusters[cluster_uuid]
+
+        self._container_clusters = container_clusters
+        self.namespaces = namespaces
+        return len(new_namespaces)
+
+    def view(self, commodities=None, metrics=None, tags=None):
+        """Return a copy of the topology sharing its namespaces and clusters, reporting the given columns
+
+        Commodities must be among the commodities the topology collected, raising ValueError otherwise.
+        """
+        if commodities and any(commodity not in self.commodities for commodity in commodities):
+            raise ValueError(f"Unknown commodities {[x for x in commodities if x not in self.commodities]}, valid options are {self.commodities}")
+        if metrics and any(metric.lower() not in SUPPORTED_METRICS for metric in metrics):
+            raise ValueError(f"Unknown metrics {[x for x in metrics if x.lower() not in SUPPORTED_METRICS]}, valid options are {SUPPORTED_METRICS}")
+
+        view = copy.copy(self)
+        view.commodities = commodities if commodities else self.commodities
+        view.metrics = [x.lower() for x in metrics] if metrics else self.metrics
+        view.tags = tags
+        view._headers = []
+        return view
+
+    @staticmethod
+    def _bounded_map(executor, func, tasks, max_pending):
+        """Generator of func(task) for each task in order, keeping at most max_pending tasks submitted to executor"""
+        pending = deque()
+
+        for task in tasks:
+            pending.append(executor.submit(func, task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    @staticmethod
+    def _set_exclude_filters(exclude_namespaces):
+        """Split excluded namespaces into server-side search criteria and a precompiled local matcher
+
+        Names made up of characters valid in a Kubernetes namespace are sent to Turbonomic as
+        RXNEQ criteria so excluded namespaces are never returned by the search.  The local matcher
+        covers every excluded name and is applied to the results as a fallback.
+        """
+        criteria = []
+        for name in exclude_namespaces:
+            if re.fullmatch(r'[A-Za-z0-9._-]+', name):
+                criteria.append({"expType":"RXNEQ",
+                                 "expVal":f".*{re.escape(name)}.*",
+                                 "filterType":"namespacesByName",
+                                 "caseSensitive":True})
+            else:
+                umsg.log(f"Excluding namespace(s) matching '{name}' locally", level=logging.DEBUG)
+
+        matcher = re.compile('|'.join(re.escape(name) for name in exclude_namespaces)) if exclude_namespaces else None
+        return criteria, matcher
+
+    def _search_namespaces(self, add_clusters=True):
+        """Generator of the namespaces returned by the Namespace search which are not excluded
+
+        The cluster of each namespace is registered for its capacity to be resolved, unless
+        add_clusters is False.
+        """
+        search_dto = {"criteriaList": self._exclude_criteria,
+                      "logicalOperator":"AND",
+                      "className":"Namespace",
+                      "scope":None}
+
+        with self.run_metrics.phase('namespace_discovery'):
+            try:
+                search = self._conn.search(dto=json.dumps(search_dto), pager=True)
+            except vc.HTTP400Error:
+                umsg.log(error_handling(), level=logging.WARNING)
+                umsg.log("Server-side namespace exclusion rejected, excluding namespaces locally", level=logging.WARNING)
+                search = self._conn.search(types=['Namespace'], pager=True)
 
         while not search.complete:
-                search_paged = search.next
+                with self.run_metrics.phase('namespace_discovery'):
+                    search_paged = search.next
 
                 for namespace in search_paged:
-                    if not any(substring in namespace['displayName'] for substring in self._exclude_namespaces):
-                        selected_Namespaces.update({namespace['uuid']:NamepaceEntity(self._conn, namespace, self._startDate, self._endDate, self.commodities)})
+                    if not (self._exclude_matcher and self._exclude_matcher.search(namespace['displayName'])) and self._in_shard(namespace['uuid']):
+                        if add_clusters:
+                            self._container_clusters.add_cluster(*NamepaceEntity._get_cluster_uuid(namespace))
+                        yield namespace
 
                 del search_paged
-        return selected_Namespaces
-    
+
+    def _in_shard(self, uuid):
+        """Return True if the namespace uuid hashes to this topology's shard, or no shard is set"""
+        return self._shard is None or zlib.crc32(uuid.encode()) % self._shard[1] == self._shard[0]
+
+    @staticmethod
+    def _batch_namespaces(namespaces, batch_size):
+        """Generator grouping namespaces into lists of batch_size"""
+        batch = []
+        for namespace in namespaces:
+            batch.append(namespace)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _create_namespace_entity(self, namespace):
+        """Create a NamepaceEntity, isolating any failure to the namespace being fetched"""
+        try:
+            start = time.perf_counter()
+            with self.run_metrics.phase('namespace_stats'):
+                entity = NamepaceEntity(self._get_thread_conn(), namespace, self._startDate, self._endDate, self.commodities, cache=self._cache,
+                                        tags=self.tags, stats_dto=self._namespace_stats_dto, windows=self._window_days)
+            self.run_metrics.record_namespace(entity.name, entity.cluster, time.perf_counter() - start)
+            return entity
+        except Exception:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot retrieve data for Namespace {namespace['displayName']}", level=logging.ERROR)
+            return None
+
+    def _create_namespace_batch(self, namespaces):
+        """Create NamepaceEntity objects for a batch of namespaces using a single multi-scope stats request
+
+        Namespaces with cached stats are not requested.  If the batched request fails, each
+        namespace in the batch is retried on its own so a failure stays isolated to the
+        namespace that caused it.
+        """
+        conn = self._get_thread_conn()
+        start = time.perf_counter()
+
+        try:
+            with self.run_metrics.phase('namespace_stats'):
+                entities = {namespace['uuid']: NamepaceEntity(conn, namespace, self._startDate, self._endDate, self.commodities, fetch_stats=False, cache=self._cache,
+                                                             tags=self.tags, stats_dto=self._namespace_stats_dto, windows=self._window_days)
+                            for namespace in namespaces}
+                uncached = {uuid: entity for uuid, entity in entities.items() if not entity.get_cached_stats()}
+
+                if uncached:
+                    stats_dto = {'scopes': list(uncached),
+                                 'period': self._namespace_stats_dto}
+                    # Samples are requested in the same order as NamepaceEntity._get_stats
+                    search = conn.request(path='stats', method='POST', query={'ascending': 'false'}, dto=json.dumps(stats_dto), pager=True)
+
+                    while not search.complete:
+
+                        search_paged = search.next
+                        for entity_stats in search_paged:
+                            if entity_stats['uuid'] in uncached:
+                                uncached[entity_stats['uuid']].add_stats(entity_stats.get('stats', []))
+
+                        del search_paged
+
+                    for entity in uncached.values():
+                        entity.summarize_stats()
+                        entity.set_cached_stats()
+
+            self.run_metrics.record_namespace(f"{namespaces[0]['displayName']} (+{len(namespaces) - 1} in batch)",
+                                              None, time.perf_counter() - start)
+            return list(entities.values())
+
+        except Exception:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot retrieve batched data for {len(namespaces)} Namespace(s), retrying individually", level=logging.ERROR)
+            return [self._create_namespace_entity(namespace) for namespace in namespaces]
+
+    def _get_thread_conn(self):
+        """Return a connection for the current thread
+
+        vmtconnect stores the last response on the Connection object before wrapping it in a
+        Pager, so each worker thread gets a shallow copy which shares the underlying session.
+        """
+        if self._fetch_workers == 1:
+            return self._conn
+
+        if not hasattr(self._thread_local, 'conn'):
+            self._thread_local.conn = copy.copy(self._conn)
+        return self._thread_local.conn
+
     @staticmethod
     def get_start_end_last_month():
         """Static method to determine the previous months first and last day"""
@@ -80,25 +416,67 @@ class NamespaceTopology():
         umsg.log(f'Pulling data between {first_daymonth.strftime("%Y-%m-%dT%H:%M:%SZ")} and {last_daymonth.strftime("%Y-%m-%dT%H:%M:%SZ")}', level=logging.INFO)
         return [first_daymonth.strftime("%Y-%m-%dT%H:%M:%SZ"),last_daymonth.strftime("%Y-%m-%dT%H:%M:%SZ")]
 
-    def _create_output(self):
-        """Method to create the list used populate the self._output attribute with data for output"""
+    @staticmethod
+    def get_start_end_day(day):
+        """Static method to determine the start and end of a single day"""
+        umsg.log(f'Pulling data between {day.strftime("%Y-%m-%dT00:00:00Z")} and {day.strftime("%Y-%m-%dT23:59:59Z")}', level=logging.INFO)
+        return [day.strftime("%Y-%m-%dT00:00:00Z"), day.strftime("%Y-%m-%dT23:59:59Z")]
+
+    def _create_output(self, namespaces=None):
+        """Generator of the output rows of each namespace, produced as each namespace's stats are retrieved
+
+        Cluster capacity is resolved by the scheduler while namespaces are collected.  Namespaces
+        whose cluster capacity is not ready yet are held back, up to REORDER_LIMIT of them, while
+        collection carries on, and rows are produced in search order so the output matches a
+        serial run.  namespaces, a list of NamepaceEntity objects, reports on those namespaces
+        instead of collecting them.
+        """
+        held = deque()
+
         # Interate through the namespaces
-        for each in self._namespaces.values():
-            # Get the number of cores and total speed for the namespace
-            cluster_cores = self._container_clusters.clusters[each.cluster_uuid].numCores
-            cluster_mhz = self._container_clusters.clusters[each.cluster_uuid].total_mhz
-            
-            # Store current namespace name and cluster in temporary list variable
-            namespace_data = [each.name, each.cluster]
+        for each in (self._get_namespaces() if namespaces is None else namespaces):
+            held.append((each, self._container_clusters.get_capacity_task(each.cluster_uuid)))
 
-            # Add tag data if requested
-            if self.tags:
-                namespace_data.extend(self._add_tag_data(each.tags))
-            
-            namespace_data.extend(self._add_stats_to_ouput(each))
-            self._output.append(namespace_data)
+            while held and (len(held) > self.REORDER_LIMIT or held[0][1] is None or held[0][1].done()):
+                yield self._create_rows(self._wait_for_capacity(*held.popleft()))
 
-        return True
+        # Every namespace is collected, wait for the capacity of the remaining clusters
+        while held:
+            yield self._create_rows(self._wait_for_capacity(*held.popleft()))
+
+        self._scheduler.log_graph()
+
+    @staticmethod
+    def _wait_for_capacity(namespace, capacity_task):
+        """Return namespace once its cluster capacity task, if any, is done"""
+        if capacity_task is not None:
+            wait([capacity_task])
+        return namespace
+
+    def _create_rows(self, namespace):
+        """Return the output rows of a namespace, one per report window"""
+        # Store current namespace name and cluster in temporary list variable
+        namespace_data = [namespace.name, namespace.cluster]
+        if self.instance:
+            namespace_data.insert(0, self.instance)
+
+        # Add tag data if requested
+        if self.tags:
+            namespace_data.extend(self._add_tag_data(namespace.tags))
+
+        if self.windows:
+            rows = [namespace_data + self._add_stats_to_ouput(namespace, stats, window)
+                    for stats, window in zip(namespace.window_stats or [{}] * len(self.windows), self.windows)]
+        else:
+            rows = [namespace_data + self._add_stats_to_ouput(namespace)]
+
+        # Join the previous run by uuid and store this run's stats for the next one
+        if self._history:
+            rows[0].extend(self._add_deltas_to_output(namespace))
+            self._history.add_namespace(namespace)
+
+        self.run_metrics.count('namespaces')
+        return rows
 
     def _add_tag_data(self, ns_tags):
         # Add tag data if requested
@@ -112,78 +490,80 @@ class NamespaceTopology():
                 continue
         return tag_output
 
-    def _add_stats_to_ouputDEPRECATED(self, namespace):
+    def _add_stats_to_ouput(self, namespace, stats=None, window=None):
         
         # Temporary list variable to store stats data
         namespace_stats =[]
-        
-        # Get the number of cores and total speed for the namespace to calculate millicores
-        cluster_cores = self._container_clusters.clusters[namespace.cluster_uuid].numCores
-        cluster_mhz = self._container_clusters.clusters[namespace.cluster_uuid].total_mhz
-        
-        # Iterate through requested commodities/metrics and store stats
-        try:
-            for commodity in self.commodities:
-                
-                stat_average = namespace.stats[commodity]['sum']/namespace.stats[commodity]['count']
-                stat_capacity = None if namespace.stats[commodity]['capacity'] == 1000000000000.0 else namespace.stats[commodity]['capacity']
-                if 'vcpu' in commodity.lower():
+        stats = namespace.stats if stats is None else stats
 
-                    namespace_stats.extend([stat_average,
-                                            self.convert_to_millicores(stat_average, cluster_cores, cluster_mhz),
-                                            namespace.stats[commodity]['peak'],
-                                            self.convert_to_millicores(namespace.stats[commodity]['peak'], cluster_cores, cluster_mhz), 
-                                            stat_capacity,
-                                            self.convert_to_millicores(stat_capacity, cluster_cores, cluster_mhz),
-                                            namespace.stats[commodity]['sum'],
-                                            self.convert_to_millicores(namespace.stats[commodity]['sum'], cluster_cores, cluster_mhz)])
-                else:
-                    namespace_stats.extend([stat_average,
-                                            namespace.stats[commodity]['peak'], 
-                                            stat_capacity,
-                                            namespace.stats[commodity]['sum']])
-        except KeyError:
-            umsg.log(error_handling(), level=logging.ERROR)
-            umsg.log(f"No data for Namespace {namespace.name} in the {namespace.cluster} Cluster", level=logging.ERROR)
-            
-        return namespace_stats
-
-    def _add_stats_to_ouput(self, namespace):
-        
-        # Temporary list variable to store stats data
-        namespace_stats =[]
+        # A window without samples is expected for new namespaces, its stats are left empty
+        if window and not stats:
+            if LOGLEVEL == 'DEBUG':
+                umsg.log(f"No data for Namespace {namespace.name} in the {namespace.cluster} Cluster for the {window.name} window", level=logging.DEBUG)
+            return [None] * sum(self._stats_width(commodity) for commodity in self.commodities)
         
         # Get the number of cores and total speed for the namespace to calculate millicores
         cluster_cores = self._container_clusters.clusters[namespace.cluster_uuid].numCores
         cluster_mhz = self._container_clusters.clusters[namespace.cluster_uuid].total_mhz
         
-        # Iterate through requested commodities/metrics and store stats
-        try:
-            for commodity in self.commodities:
-                for metric in self.metrics:
+        # Iterate through requested commodities/metrics and store stats, a missing commodity or metric is left empty
+        missing = []
+        for commodity in self.commodities:
+            for metric in self.metrics:
+                try:
                     if metric == 'average':
-                        stat_average = namespace.stats[commodity]['sum']/namespace.stats[commodity]['count']
-                        namespace_stats.append(stat_average)
-                        if 'vcpu' in commodity.lower():
-                            namespace_stats.append(self.convert_to_millicores(stat_average, cluster_cores, cluster_mhz))
-
+                        value = stats[commodity]['sum']/stats[commodity]['count']
                     elif metric == 'capacity':
-                        stat_capacity = None if namespace.stats[commodity]['capacity'] == 1000000000000.0 else namespace.stats[commodity]['capacity']
-                        namespace_stats.append(stat_capacity)
-                        if 'vcpu' in commodity.lower():
-                            namespace_stats.append(self.convert_to_millicores(stat_capacity, cluster_cores, cluster_mhz))
+                        value = None if stats[commodity]['capacity'] == UNLIMITED_CAPACITY else stats[commodity]['capacity']
                     else:
-                        namespace_stats.append(namespace.stats[commodity][metric])
-                        if 'vcpu' in commodity.lower():
-                            namespace_stats.append(self.convert_to_millicores(namespace.stats[commodity][metric], cluster_cores, cluster_mhz))
-        except KeyError:
-            umsg.log(error_handling(), level=logging.ERROR)
-            umsg.log(f"No data for Namespace {namespace.name} in the {namespace.cluster} Cluster", level=logging.ERROR)
+                        value = stats[commodity][metric]
+                except KeyError:
+                    value = None
+                    if commodity not in missing:
+                        missing.append(commodity)
+
+                namespace_stats.append(value)
+                if 'vcpu' in commodity.lower():
+                    namespace_stats.append(self.convert_to_millicores(value, cluster_cores, cluster_mhz))
+
+        if missing and not window:
+            umsg.log(f"No data for Namespace {namespace.name} in the {namespace.cluster} Cluster: {missing}", level=logging.ERROR)
+        elif missing and LOGLEVEL == 'DEBUG':
+            umsg.log(f"No data for Namespace {namespace.name} in the {namespace.cluster} Cluster for the {window.name} window: {missing}",
+                     level=logging.DEBUG)
 
         return namespace_stats
 
+    def _stats_width(self, commodity):
+        """Return the number of stats columns of a commodity, VCPU metrics have a Millicores column as well"""
+        return len(self.metrics) * (2 if 'vcpu' in commodity.lower() else 1)
+
+    def _add_deltas_to_output(self, namespace):
+        """Return the change and percentage change of each delta metric since the previous run, None when unknown"""
+        previous = self._history.get_previous_stats(namespace.uuid)
+        deltas = []
+
+        for commodity in self.commodities:
+            for metric in self._delta_metrics:
+                try:
+                    current, before = namespace.stats[commodity][metric], previous[commodity][metric]
+                except (KeyError, TypeError):
+                    deltas.extend([None, None])
+                    continue
+
+                if UNLIMITED_CAPACITY in (current, before):
+                    deltas.extend([None, None])
+                else:
+                    deltas.extend([current - before, (current - before) / before * 100 if before else None])
+
+        return deltas
+
     def convert_to_millicores(self, value, numcores, capacity):
         """Method to convert MHz to Millicores"""
+        # Unlimited capacities are reported as None, skip them without logging as umsg inspects the stack on every call
+        if value is None:
+            return None
+
         try:
             return (value/capacity) * (numcores * 1000)
         except (TypeError, ZeroDivisionError):
@@ -191,33 +571,9 @@ class NamespaceTopology():
             umsg.log(f"Cannot determine millicores with a value of {value} and capacity of {capacity}", level=logging.DEBUG)
             return None
 
-    def _create_headersOLD(self):
-        """Method to create header list for CSV output of requested commodities/metrics"""
-        self._headers = ['Namespace', 'Cluster']
-        if self.tags:
-            for tag in self.tags:
-                self._headers.append(tag)
-        
-        for metric in self.commodities:
-            if 'vcpu' in metric.lower():
-                self._headers.extend([f"{metric} Average (Mhz)",
-                                     f"{metric} Average (Millicores)", 
-                                     f"{metric} Peak (Mhz)",
-                                     f"{metric} Peak (Millicores)",
-                                     f"{metric} Capacity (Mhz)",
-                                     f"{metric} Capacity (Millicores)",
-                                     f"{metric} Monthly Sum (Mhz)",
-                                     f"{metric} Monthly Sum (Millicores)"])
-            else:
-                self._headers.extend([f"{metric} Average (KB)", 
-                                     f"{metric} Peak (KB)",
-                                     f"{metric} Capacity (KB)",
-                                     f"{metric} Monthly Sum (KB)"])
-        return True
-
     def _create_headers(self):
         """Method to create header list for CSV output of requested commodities/metrics"""
-        self._headers = ['Namespace', 'Cluster']
+        self._headers = ['Instance', 'Namespace', 'Cluster'] if self.instance else ['Namespace', 'Cluster']
         if self.tags:
             for tag in self.tags:
                 self._headers.append(tag)
@@ -232,53 +588,458 @@ class NamespaceTopology():
                 else:
                     self._headers.append(f"{commodity} {metric.title()} (KB)")
 
+        if self._history:
+            for commodity in self.commodities:
+                for metric in self._delta_metrics:
+                    unit = 'Mhz' if 'vcpu' in commodity.lower() else 'KB'
+                    self._headers.append(f"{commodity} {metric.title()} Change ({unit})")
+                    self._headers.append(f"{commodity} {metric.title()} Change (%)")
+
         return True
 
 
     def output_to_csv(self, filename):
-        """Method to output data to CSV"""
-        self._create_headers()
-        self._create_output()
-        
-        umsg.log(f"Saving file {filename}", level=logging.INFO)
-        with open(filename, 'w', newline='') as output_file:
-            write_out = csv.writer(output_file)
-            write_out.writerow(self._headers)
-            write_out.writerows(self._output)
+        """Method to output data to CSV, writing each row as it is produced"""
+        return self.output_to_file(filename, 'csv')
 
     def output_to_xlsx(self, filename):
-        workbook = openpyxl.Workbook(write_only=True)
+        """Method to output data to XLSX using a write only (streaming) workbook"""
+        return self.output_to_file(filename, 'xlsx')
+
+    def output_partial(self, filename):
+        """Method to output data as a partial result, one JSON list per line starting with the headers
+
+        Partial results keep the value types of each row so they can be merged into any output format.
+        """
+        return self.output_to_file(filename, 'jsonl')
+
+    def output_rows(self, namespaces=None):
+        """Generator of the headers followed by the output rows, for a topology without report windows"""
+        self._create_headers()
+        yield self._headers
+        for rows in self._create_output(namespaces):
+            yield from rows
+
+    def output_to_file(self, filename, filetype='csv', namespaces=None):
+        """Method to output data in the given filetype: csv, csv.gz, xlsx, parquet or jsonl (a partial result)
+
+        With report windows an XLSX file gets a sheet per window and other filetypes a file per
+        window, named after it.  namespaces, a list of NamepaceEntity objects, reports on those
+        namespaces instead of collecting them.  With a previous run in the run history the top_growth
+        namespaces with the largest increase in the first delta column get a growth sheet, or a
+        growth file for filetypes other than XLSX.  Returns the list of files written.
+        """
+        self._create_headers()
+        windows = self.windows if self.windows else [None]
+
+        if filetype.lower() == 'xlsx' or len(windows) == 1:
+            writers = [ReportWriter(filename, filetype)]
+            sheets = [(writers[0], writers[0].add_sheet(self._headers, title=window.name if window else None)) for window in windows]
+        else:
+            writers = [ReportWriter(self.window_filename(filename, window.name), filetype) for window in windows]
+            sheets = [(writer, writer.add_sheet(self._headers)) for writer in writers]
+
+        growth = None
+        if self._history:
+            previous = self._history.start_run(f'{self._startDate[:10]}..{self._endDate[:10]}', self.commodities)
+            umsg.log(f"Reporting changes since the run of {previous}" if previous else "No previous run in the run history, changes are left empty",
+                     level=logging.INFO)
+            if previous:
+                # The delta columns end the row, the first one is counted from the end
+                growth, growth_index = [], -2 * len(self.commodities) * len(self._delta_metrics)
+
+        complete = False
+        try:
+            for count, rows in enumerate(self._create_output(namespaces)):
+                for (writer, sheet), row in zip(sheets, rows):
+                    writer.write(row, sheet)
+
+                # Keep the top_growth rows with the largest increase in a min heap
+                if growth is not None and rows[0][growth_index] and rows[0][growth_index] > 0:
+                    item = (rows[0][growth_index], count, rows[0])
+                    if len(growth) < self._top_growth:
+                        heapq.heappush(growth, item)
+                    elif growth:
+                        heapq.heappushpop(growth, item)
+
+            if growth is not None:
+                if filetype.lower() == 'xlsx':
+                    growth_writer = writers[0]
+                else:
+                    growth_writer = ReportWriter(self.window_filename(filename, 'growth'), filetype)
+                    writers.append(growth_writer)
+                growth_sheet = growth_writer.add_sheet(self._headers, title='growth')
+                for _, _, row in sorted(growth, reverse=True):
+                    growth_writer.write(row, growth_sheet)
+            complete = True
+        finally:
+            if self._history:
+                self._history.finish_run(complete)
+            for writer in writers:
+                writer.close(complete)
+        return [writer.filename for writer in writers]
+
+    @staticmethod
+    def window_filename(filename, window):
+        """Return filename with the window name added before its extension(s)"""
+        path, basename = os.path.split(filename)
+        stem, dot, extension = basename.partition('.')
+        return os.path.join(path, f'{stem}_{window}{dot}{extension}')
+
+    @staticmethod
+    def read_partial(filename):
+        """Generator of the rows of a partial result written by output_partial, starting with the headers"""
+        with open(filename) as partial_file:
+            for line in partial_file:
+                yield json.loads(line)
+
+    @staticmethod
+    def merge_partials(filenames, filename, filetype='csv'):
+        """Combine partial results into a single output file, streaming the rows of each partial in turn"""
+        headers = None
+        partials = []
+
+        for partial_filename in filenames:
+            partial = NamespaceTopology.read_partial(partial_filename)
+            partial_headers = next(partial, None)
+            if partial_headers is None:
+                umsg.log(f"Skipping empty partial result {partial_filename}", level=logging.WARNING)
+                continue
+            if headers is None:
+                headers = partial_headers
+            elif partial_headers != headers:
+                umsg.log(f"Skipping partial result {partial_filename} with different columns", level=logging.ERROR)
+                continue
+            partials.append(partial)
+
+        umsg.log(f"Merging {len(partials)} partial result(s)", level=logging.INFO)
+        NamespaceTopology.write_file(filename, filetype, headers or [], (row for partial in partials for row in partial))
+
+    @staticmethod
+    def write_file(filename, filetype, headers, rows):
+        """Write headers and rows to a single sheet file of the given filetype"""
+        with ReportWriter(filename, filetype) as writer:
+            sheet = writer.add_sheet(headers)
+            for row in rows:
+                writer.write(row, sheet)
+
+
+class ReportWriter():
+    """Streaming writer of report sheets to csv, csv.gz, xlsx, parquet or jsonl (partial result) files
 
-        ns_data = workbook.create_sheet(title=filename.split('.')[0])
-        ns_data.append(self._headers)
-        for row in self._output:
-            ns_data.append(row)
+    Rows are written as they are produced so the report is never held in memory.  An XLSX file
+    holds every sheet added to it as a worksheet, the other filetypes hold a single sheet.
+    Parquet files have the stats columns as floats, with empty values and unlimited capacities as
+    nulls, and are written in row groups of row_group_size rows.
+    """
+
+    def __init__(self, filename, filetype='csv', row_group_size=10000):
+        self.filename = filename
+        self.filetype = filetype.lower()
+        self._row_group_size = row_group_size
+        self._sheets = []
+        self._workbook = openpyxl.Workbook(write_only=True) if self.filetype == 'xlsx' else None
         umsg.log(f"Saving file {filename}", level=logging.INFO)
-        workbook.save(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def add_sheet(self, headers, title=None):
+        """Add a sheet starting with headers, returning its index for write"""
+        if self._sheets and self._workbook is None:
+            raise ValueError(f"A {self.filetype} file holds a single sheet")
+
+        if self._workbook is not None:
+            # Sheet titles are limited to 31 characters and cannot contain a path
+            worksheet = self._workbook.create_sheet(title=(title if title else os.path.basename(self.filename).split('.')[0])[:31])
+            worksheet.append(headers)
+            sheet = {'title': title, 'write': worksheet.append, 'close': None}
+        elif self.filetype == 'parquet':
+            sheet = self._open_parquet(headers)
+        else:
+            sheet = self._open_text(headers)
+
+        sheet['count'] = 0
+        self._sheets.append(sheet)
+        return len(self._sheets) - 1
+
+    def write(self, row, sheet=0):
+        self._sheets[sheet]['write'](row)
+        self._sheets[sheet]['count'] += 1
+
+    def _open_text(self, headers):
+        """Open a csv, csv.gz or jsonl file, writing jsonl to a temporary file which replaces filename once complete"""
+        if self.filetype == 'jsonl':
+            tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+            output_file = open(tmp_filename, 'w')
+            output_file.write(json.dumps(headers) + '\n')
+
+            def close(complete):
+                output_file.close()
+                if complete:
+                    os.replace(tmp_filename, self.filename)
+                else:
+                    os.remove(tmp_filename)
+
+            return {'title': None, 'write': lambda row: output_file.write(json.dumps(row) + '\n'), 'close': close}
+
+        output_file = gzip.open(self.filename, 'wt', newline='') if self.filetype == 'csv.gz' else open(self.filename, 'w', newline='')
+        write_out = csv.writer(output_file)
+        write_out.writerow(headers)
+        return {'title': None, 'write': write_out.writerow, 'close': lambda complete: output_file.close()}
+
+    @staticmethod
+    def parquet_schema(headers):
+        """Return the Parquet schema for headers, with stats columns as floats and the rest as strings"""
+        return pa.schema([(header, pa.float64() if header.endswith((' (Mhz)', ' (Millicores)', ' (KB)', ' (%)')) else pa.string())
+                          for header in headers])
+
+    def _open_parquet(self, headers):
+        """Open a zstd compressed Parquet file, buffering rows into row groups"""
+        if pa is None:
+            raise RuntimeError('The parquet filetype requires the pyarrow package')
+
+        schema = self.parquet_schema(headers)
+        float_columns = [index for index, field in enumerate(schema) if field.type == pa.float64()]
+        writer = pq.ParquetWriter(self.filename, schema, compression='zstd')
+        batch = []
+
+        def write_row_group():
+            columns = list(zip(*batch))
+            for index in float_columns:
+                columns[index] = [None if value in ('', UNLIMITED_CAPACITY) else value for value in columns[index]]
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                                    schema=schema))
+            batch.clear()
+
+        def write(row):
+            # Columns are built from every row, so a short row is padded with nulls
+            batch.append(row if len(row) >= len(schema) else list(row) + [None] * (len(schema) - len(row)))
+            if len(batch) >= self._row_group_size:
+                write_row_group()
+
+        def close(complete):
+            if batch and complete:
+                write_row_group()
+            writer.close()
+
+        return {'title': None, 'write': write, 'close': close}
+
+    @staticmethod
+    def read(filename, filetype='csv'):
+        """Generator of (title, rows) for each sheet of a report, the rows starting with the headers"""
+        filetype = filetype.lower()
+
+        if filetype == 'xlsx':
+            workbook = openpyxl.load_workbook(filename, read_only=True)
+            try:
+                for worksheet in workbook.worksheets:
+                    yield worksheet.title, worksheet.iter_rows(values_only=True)
+            finally:
+                workbook.close()
+        elif filetype == 'parquet':
+            parquet_file = pq.ParquetFile(filename)
+
+            def parquet_rows():
+                yield parquet_file.schema_arrow.names
+                for batch in parquet_file.iter_batches():
+                    yield from zip(*(column.to_pylist() for column in batch.columns))
+
+            yield None, parquet_rows()
+        elif filetype == 'jsonl':
+            yield None, NamespaceTopology.read_partial(filename)
+        else:
+            with (gzip.open(filename, 'rt', newline='') if filetype == 'csv.gz' else open(filename, newline='')) as input_file:
+                yield None, csv.reader(input_file)
+
+    def close(self, complete=True):
+        """Close every sheet and save the file, discarding a partial result that is not complete"""
+        for sheet in self._sheets:
+            if sheet['close']:
+                sheet['close'](complete)
+        if self._workbook is not None and complete:
+            self._workbook.save(self.filename)
+
+        for sheet in self._sheets:
+            sheet_title = f" sheet {sheet['title']}" if sheet['title'] else ''
+            umsg.log(f"Saved {sheet['count']} namespace(s) to {self.filename}{sheet_title}", level=logging.INFO)
+
+
+class ReportDelivery():
+    """Prepares report files for delivery within the limits of the SMTP relay
+
+    Attachments that are not already compressed are zipped.  A report whose attachment is larger
+    than an email allows is split by rows into numbered parts, each a complete report with the
+    headers of every sheet, and the attachments are grouped into as few emails as possible without
+    any going over max_email_mb.  Attachments are base64 encoded in the email, growing them by a
+    third, so only three quarters of max_email_mb is used for them.  With a bucket the reports are
+    uploaded to S3, or an S3 compatible store such as MinIO, and only presigned links are emailed.
+    """
+    COMPRESSED_FILETYPES = ('csv.gz', 'xlsx', 'parquet')
+
+    def __init__(self, filetype='csv', compress=True, max_email_mb=10, bucket=None, endpoint=None, prefix='',
+                 access_key=None, secret_key=None, region=None, url_expiry=604800):
+        self.filetype = filetype.lower()
+        self._compress = compress and self.filetype not in self.COMPRESSED_FILETYPES
+        self._max_bytes = int(max_email_mb * 1024 * 1024 * 0.75) if max_email_mb else None
+        self.bucket = bucket
+        self._s3_params = {'endpoint_url': endpoint, 'aws_access_key_id': access_key, 'aws_secret_access_key': secret_key,
+                           'region_name': region}
+        self._prefix = prefix
+        self.url_expiry = url_expiry
+        self._created = []
+
+    def get_emails(self, filenames):
+        """Return the attachments of each email needed to deliver filenames"""
+        attachments = []
+        for filename in filenames:
+            if not os.path.exists(filename):
+                umsg.log(f"Report file {filename} not found, skipping", level=logging.WARNING)
+                continue
+            attachments.extend(self._get_attachments(filename))
+
+        emails = [[]]
+        size = 0
+        for attachment in attachments:
+            attachment_size = os.path.getsize(attachment)
+            if emails[-1] and self._max_bytes and size + attachment_size > self._max_bytes:
+                emails.append([])
+                size = 0
+            emails[-1].append(attachment)
+            size += attachment_size
+
+        return emails
+
+    def _get_attachments(self, filename):
+        """Return the attachment(s) of a report, split into parts when it does not fit in an email"""
+        attachment = self._compress_file(filename)
+        if self._max_bytes is None or os.path.getsize(attachment) <= self._max_bytes:
+            return [attachment]
+
+        # Leave headroom for parts compressing less well than the whole report
+        parts = math.ceil(os.path.getsize(attachment) / (self._max_bytes * 0.9))
+        rows = max(sum(1 for _ in sheet_rows) - 1 for _, sheet_rows in ReportWriter.read(filename, self.filetype))
+        self._remove([attachment] if attachment != filename else [])
+
+        while True:
+            parts = max(1, min(parts, rows))
+            attachments = [self._compress_file(part) for part in self._split(filename, parts, rows)]
+            if all(os.path.getsize(attachment) <= self._max_bytes for attachment in attachments) or parts >= rows:
+                break
+            self._remove(attachments)
+            parts *= 2
+
+        umsg.log(f"Split {filename} into {len(attachments)} part(s) of at most {self._max_bytes} bytes", level=logging.INFO)
+        return attachments
+
+    def _split(self, filename, parts, rows):
+        """Split a report by rows into parts, each holding every sheet, returning the part filenames"""
+        rows_per_part = math.ceil(rows / parts) if rows else 1
+        part_filenames = [NamespaceTopology.window_filename(filename, f'part{part}of{parts}') for part in range(1, parts + 1)]
+        writers = [ReportWriter(part_filename, self.filetype) for part_filename in part_filenames]
+        self._created.extend(part_filenames)
+
+        try:
+            for title, sheet_rows in ReportWriter.read(filename, self.filetype):
+                headers = next(sheet_rows)
+                sheets = [writer.add_sheet(list(headers), title) for writer in writers]
+                for index, row in enumerate(sheet_rows):
+                    writers[index // rows_per_part].write(list(row), sheets[index // rows_per_part])
+        finally:
+            for writer in writers:
+                writer.close()
+
+        return part_filenames
+
+    def _compress_file(self, filename):
+        """Zip filename unless its filetype is already compressed, returning the file to attach"""
+        if not self._compress:
+            return filename
+
+        zip_filename = f'{filename}.zip'
+        with zipfile.ZipFile(zip_filename, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.write(filename, arcname=os.path.basename(filename))
+        self._created.append(zip_filename)
+        return zip_filename
+
+    def upload(self, filenames):
+        """Upload the compressed reports to the bucket, returning a presigned link to each"""
+        client = boto3.client('s3', **{key: value for key, value in self._s3_params.items() if value})
+        links = []
+
+        for filename in filenames:
+            attachment = self._compress_file(filename)
+            key = f'{self._prefix}{os.path.basename(attachment)}'
+            # upload_file uses concurrent multipart uploads for large files
+            client.upload_file(attachment, self.bucket, key)
+            umsg.log(f"Uploaded {attachment} to s3://{self.bucket}/{key}", level=logging.INFO)
+            links.append(client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+                                                       ExpiresIn=self.url_expiry))
+
+        return links
+
+    def _remove(self, filenames):
+        for filename in filenames:
+            if filename in self._created:
+                self._created.remove(filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def cleanup(self):
+        """Remove the compressed attachments and parts created for delivery"""
+        self._remove(list(self._created))
 
 
 class NamepaceEntity():
+    """Record of a namespace and its stats
 
-    def __init__(self, conn, namespace, startDate, endDate, commodities):
+    Uses __slots__ to keep the per-namespace footprint small.  The stats DTO is shared between
+    every namespace of a NamespaceTopology, and only the requested tags are kept.  When windows,
+    a list of (first day, last day) ordinals, is given the day of every sample is kept as well and
+    window_stats holds the stats of each window.
+    """
+    __slots__ = ('_conn', '_cache', 'uuid', 'name', 'tags', 'cluster_uuid', 'cluster', '_namespace_stats_dto', '_samples', 'stats',
+                 '_windows', 'window_stats')
+
+    def __init__(self, conn, namespace, startDate, endDate, commodities, fetch_stats=True, cache=None, tags=None, stats_dto=None, windows=None):
         self._conn = conn
-        self._uuid = namespace['uuid']
+        self._cache = cache
+        self._windows = windows
+        self.window_stats = None
+        self.uuid = namespace['uuid']
         self.name = namespace['displayName']
-        self.tags = namespace.get('tags', {})
+        self.tags = self._get_tags(namespace, tags)
         self.cluster_uuid, self.cluster = self._get_cluster_uuid(namespace)
-        self._startDate = startDate
-        self._endDate = endDate
-        self._namespace_stats_dto = self._set_stats_dto(commodities)
-        self.stats = self._get_stats()
+        self._namespace_stats_dto = stats_dto if stats_dto else self._set_stats_dto(startDate, endDate, commodities)
+        self._samples = {}
+        self.stats = {}
+
+        if fetch_stats and not self.get_cached_stats():
+            self._get_stats()
+            self.set_cached_stats()
 
-    def _get_cluster_uuid(self, namespace):
+    @staticmethod
+    def _get_tags(namespace, tags):
+        """Return the namespace tags, limited to tags if given"""
+        ns_tags = namespace.get('tags', {})
+        if tags:
+            return {tag: ns_tags[tag] for tag in tags if tag in ns_tags}
+        return ns_tags
+
+    @staticmethod
+    def _get_cluster_uuid(namespace):
         for provider in namespace['providers']:
             if provider['className'] == 'ContainerPlatformCluster':
                 return [provider['uuid'], provider['displayName']]
         return [None, None]
     
-    def _set_stats_dto(self, commodities):
+    @staticmethod
+    def _set_stats_dto(startDate, endDate, commodities):
         stats_dto = {"statistics":[],
-            "startDate":self._startDate,"endDate":self._endDate}
+            "startDate":startDate,"endDate":endDate}
 
         for metric in commodities:
             stats_dto['statistics'].append({'name':metric,'relatedEntityType':'Namespace'})
@@ -286,60 +1047,222 @@ class NamepaceEntity():
         return stats_dto
 
     def _get_stats(self):
-        search = self._conn.request(path=f'stats/{self._uuid}?ascending=false', method='POST', query={'ascending': False}, dto=json.dumps(self._namespace_stats_dto), pager=True)
-        
-        # print(f'stats/{self._uuid}')
-        # print(json.dumps(self._namespace_stats_dto))
-        stats = {}
+        search = self._conn.request(path=f'stats/{self.uuid}', method='POST', query={'ascending': 'false'}, dto=json.dumps(self._namespace_stats_dto), pager=True)
+        self.stats = {}
 
         while not search.complete:
 
             search_paged = search.next
-            # if self.name == 'irf3':
-            #     print(json.dumps(search_paged))
-            for date_stats in search_paged:
-                if date_stats['epoch'] == 'HISTORICAL':
-
-                    for metric in date_stats['statistics']:
-
-                        try:
-                            stats.update({metric['name']:{'count': stats[metric['name']]['count']+1, 
-                                                            'sum': metric['values']['avg']+stats[metric['name']]['sum'],
-                                                            'peak': max(metric['values']['max'],stats[metric['name']]['peak']),
-                                                            'capacity': metric['capacity']['total']}})
-                        except KeyError:
-                            stats.update({metric['name']:{'count': 1, 
-                                                            'sum': metric['values']['avg'], 
-                                                            'peak': metric['values']['max'],
-                                                            'capacity':metric['capacity']['total']}})
-                            continue
-                        except Exception as e:
-                            umsg.log(error_handling(), level=logging.ERROR)
-                            umsg.log(f"Cannot save data for {self.name} in {self.cluster}", level=logging.ERROR)
-                            continue
+            self.add_stats(search_paged)
                         
             del search_paged
-        # print(self.name, self.cluster, stats)
-        return stats
+        return self.summarize_stats()
+
+    def _get_cache_key(self):
+        key = ('stats_v3', self.uuid, [stat['name'] for stat in self._namespace_stats_dto['statistics']],
+               self._namespace_stats_dto['startDate'], self._namespace_stats_dto['endDate'])
+        return key + (self._windows,) if self._windows else key
+
+    def get_cached_stats(self):
+        """Load self.stats from the response cache, returning True on a cache hit"""
+        if self._cache is None:
+            return False
+
+        stats = self._cache.get(self._get_cache_key())
+        if stats is None:
+            return False
+
+        if self._windows:
+            self.window_stats = [{name: CommodityStats(**values) for name, values in window.items()} for window in stats['windows']]
+            stats = stats['stats']
+        self.stats = {name: CommodityStats(**values) for name, values in stats.items()}
+        return True
+
+    def set_cached_stats(self):
+        """Store self.stats, and self.window_stats with windows, in the response cache"""
+        if self._cache is not None:
+            stats = {name: values.to_dict() for name, values in self.stats.items()}
+            if self._windows:
+                stats = {'stats': stats,
+                         'windows': [{name: values.to_dict() for name, values in window.items()} for window in self.window_stats]}
+            self._cache.set(self._get_cache_key(), stats)
+
+    def add_stats(self, snapshots):
+        """Collect the samples from a list of stat snapshots, call summarize_stats once all snapshots are added"""
+        for date_stats in snapshots:
+            if date_stats['epoch'] == 'HISTORICAL':
+
+                for metric in date_stats['statistics']:
+
+                    try:
+                        avg, peak, capacity = metric['values']['avg'], metric['values']['max'], metric['capacity']['total']
+                    except Exception:
+                        umsg.log(error_handling(), level=logging.ERROR)
+                        umsg.log(f"Cannot save data for {self.name} in {self.cluster}", level=logging.ERROR)
+                        continue
+
+                    samples = self._samples.setdefault(metric['name'], [array('d'), array('d'), None, array('d'), array('d')])
+                    samples[0].append(avg)
+                    samples[1].append(peak)
+                    # The capacity of the latest sample is reported, whatever order the samples are returned in
+                    if samples[2] is None or date_stats['date'] >= samples[2][0]:
+                        samples[2] = (date_stats['date'], capacity)
+                    if self._windows:
+                        samples[3].append(capacity)
+                        samples[4].append(datetime.date.fromisoformat(date_stats['date'][:10]).toordinal())
+
+    def summarize_stats(self):
+        """Reduce the collected samples into self.stats, and self.window_stats with windows, and release them"""
+        self.stats = {name: self.summarize_samples(np.frombuffer(values), np.frombuffer(peaks), capacity)
+                      for name, (values, peaks, (_, capacity), _, _) in self._samples.items()}
+
+        if self._windows:
+            self.window_stats = [{} for _ in self._windows]
+            for name, (values, peaks, _, capacities, days) in self._samples.items():
+                values, peaks, capacities, days = (np.frombuffer(samples) for samples in (values, peaks, capacities, days))
+                for window_stats, (first_day, last_day) in zip(self.window_stats, self._windows):
+                    in_window = (days >= first_day) & (days <= last_day)
+                    if in_window.any():
+                        latest = np.argmax(days[in_window])
+                        window_stats[name] = self.summarize_samples(values[in_window], peaks[in_window], float(capacities[in_window][latest]))
+
+        self._samples = {}
+        return self.stats
+
+    @staticmethod
+    def summarize_samples(values, peaks, capacity):
+        """Reduce arrays of sample averages and peaks to every metric in SUPPORTED_METRICS"""
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+
+        return CommodityStats(count=int(values.size),
+                              sum=float(values.sum()),
+                              average=float(values.mean()),
+                              peak=float(peaks.max()),
+                              capacity=capacity,
+                              median=float(p50),
+                              p50=float(p50),
+                              p95=float(p95),
+                              p99=float(p99),
+                              stddev=float(values.std()))
+
+
+class CommodityStats():
+    """Slotted summary of a namespace's samples for one commodity, indexable by metric name"""
+    __slots__ = ('count', 'sum', 'average', 'peak', 'capacity', 'median', 'p50', 'p95', 'p99', 'stddev')
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values[field])
+
+    def __getitem__(self, metric):
+        try:
+            return getattr(self, metric)
+        except AttributeError:
+            raise KeyError(metric)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        return f"CommodityStats({self.to_dict()})"
+
+
+class ReportWindow():
+    """A named range of days to report on, with the first and last day included"""
+    __slots__ = ('name', 'start', 'end')
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"{self.name} ({self.start.isoformat()} - {self.end.isoformat()})"
+
+    @classmethod
+    def parse(cls, windows, today=None):
+        """Parse report windows separated by a colon ':', e.g. 'month:weekly=4:rolling=90:2026-01-01..2026-03-31'
+
+        month is the previous calendar month, weekly=N each of the last N complete weeks (Monday to
+        Sunday, 4 if N is not given), rolling=N the last N days up to yesterday and START..END the
+        days from START to END.
+        """
+        today = today if today else datetime.date.today()
+        report_windows = []
+
+        for window in filter(None, windows.split(':')):
+            kind, _, value = window.partition('=')
+            if kind == 'month':
+                end = today.replace(day=1) - datetime.timedelta(days=1)
+                report_windows.append(cls(end.strftime('%Y-%m'), end.replace(day=1), end))
+            elif kind == 'weekly':
+                last_sunday = today - datetime.timedelta(days=today.isoweekday())
+                for week in range(int(value) if value else 4, 0, -1):
+                    end = last_sunday - datetime.timedelta(weeks=week - 1)
+                    report_windows.append(cls(f'week_{(end - datetime.timedelta(days=6)).isoformat()}', end - datetime.timedelta(days=6), end))
+            elif kind == 'rolling':
+                end = today - datetime.timedelta(days=1)
+                report_windows.append(cls(f'rolling_{int(value)}d', end - datetime.timedelta(days=int(value) - 1), end))
+            elif '..' in window:
+                start, end = (datetime.date.fromisoformat(day) for day in window.split('..', 1))
+                if start > end:
+                    raise ValueError(f"Report window {window} ends before it starts")
+                report_windows.append(cls(f'{start.isoformat()}_{end.isoformat()}', start, end))
+            else:
+                raise ValueError(f"Unknown report window {window}")
+
+        return report_windows
 
 
 class ClusterTopology():
+    """Class to represent the Kubernetes clusters hosting reported namespaces
 
-    def __init__(self, conn, exclude_master):
-        self._conn = conn
+    Cluster capacity is resolved lazily on the first lookup of a cluster in self.clusters and
+    memoized.  Clusters registered through add_cluster are resolved together in that first
+    lookup so their VCPU capacities share a single stats request.
+
+    With a scheduler the master nodes are collected by a ``master_nodes`` task, and each
+    registered cluster gets a ``cluster_capacity:<uuid>`` task which runs after it, so capacity
+    is resolved in the background while namespaces are still being collected.
+    """
+
+    def __init__(self, conn, exclude_master, cache=None, run_metrics=None, scheduler=None):
+        # Scheduler tasks run on their own thread so they get their own copy of the connection
+        self._conn = copy.copy(conn) if scheduler else conn
+        self._cache = cache
+        self._run_metrics = run_metrics if run_metrics else RunMetrics()
+        self._scheduler = scheduler
+        self._capacity_tasks = {}
 
-        if exclude_master:
-            # self._exclude_master = set(exclude_master.split(':'))
-            self._master_nodes = self._get_master_Nodes(exclude_master)
+        if scheduler:
+            self._master_nodes_task = scheduler.add('master_nodes', self._get_master_nodes_phase, exclude_master)
         else:
-            self._exclude_master = {}
-        
-        self.clusters = self._get_k8s_clusters()
+            self._master_nodes_task = Future()
+            self._master_nodes_task.set_result(self._get_master_nodes_phase(exclude_master))
+
+        self._pending_clusters = {}
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self.clusters = LazyClusterDict(self._get_k8s_clusters)
+
+    def _get_master_nodes_phase(self, exclude_master):
+        if not exclude_master:
+            return set()
+
+        with self._run_metrics.phase('master_nodes'):
+            return self._get_master_Nodes(exclude_master)
 
     def _get_master_Nodes(self, exclude_master):
-        master_nodes = []
+        master_nodes = set()
 
         for node_group in exclude_master:
+            if self._cache is not None:
+                cached_nodes = self._cache.get(('master_nodes', node_group))
+                if cached_nodes is not None:
+                    master_nodes.update(cached_nodes)
+                    continue
+
+            group_nodes = set()
             search_dto = {"criteriaList":
                             [{"expType":"RXEQ",
                               "expVal":f"{node_group}.*",
@@ -355,45 +1278,96 @@ class ClusterTopology():
                 search_paged = search.next
                 for group in search_paged:
 
-                    master_nodes.extend(group['memberUuidList'])
+                    group_nodes.update(group['memberUuidList'])
 
                 del search_paged
-        umsg.log(f"Master Nodes: {master_nodes}", level=logging.INFO)
+
+            master_nodes.update(group_nodes)
+            if self._cache is not None:
+                self._cache.set(('master_nodes', node_group), sorted(group_nodes))
+        umsg.log(f"Master Nodes: {sorted(master_nodes)}", level=logging.INFO)
         return master_nodes
 
-    def _get_k8s_clusters(self):
-        clusters = {}
-        search_dto = {"criteriaList":[],
-                      "logicalOperator":"AND",
-                      "className":"ContainerPlatformCluster",
-                      "scope":None}
+    def add_cluster(self, cluster_uuid, name=None):
+        """Register a cluster hosting a reported namespace so it is resolved with the next lookup
 
-        search = self._conn.search(dto=json.dumps(search_dto), pager=True)
+        With a scheduler, a task resolving the cluster's capacity is added on its first registration.
+        """
+        if cluster_uuid and cluster_uuid not in self.clusters:
+            with self._pending_lock:
+                if cluster_uuid in self._capacity_tasks:
+                    return
+                self._pending_clusters.setdefault(cluster_uuid, name)
+                if self._scheduler:
+                    self._capacity_tasks[cluster_uuid] = self._scheduler.add(f'cluster_capacity:{cluster_uuid}', self.clusters.__getitem__,
+                                                                             cluster_uuid, after=['master_nodes'])
 
-        while not search.complete:
+    def get_capacity_task(self, cluster_uuid):
+        """Return the Future of the scheduler task resolving cluster_uuid's capacity, or None if it has none"""
+        return self._capacity_tasks.get(cluster_uuid)
 
-            search_paged = search.next
-            for cluster in search_paged:
-                
-                clusters.update({cluster['uuid']: ClusterNodes(self._conn, cluster, self._master_nodes)})
+    def _get_k8s_clusters(self, cluster_uuid):
+        """Resolve the capacity of cluster_uuid and any pending clusters, returning cluster_uuid's ClusterNodes"""
+        master_nodes = self._master_nodes_task.result()
 
-            del search_paged
-        return clusters
+        with self._lock, self._run_metrics.phase('cluster_capacity'):
+            if cluster_uuid in self.clusters:
+                return self.clusters[cluster_uuid]
 
+            with self._pending_lock:
+                self._pending_clusters.setdefault(cluster_uuid, None)
+                k8s_clusters = {uuid: name for uuid, name in self._pending_clusters.items() if uuid not in self.clusters}
+                self._pending_clusters = {}
 
-class ClusterNodes():
-    
-    def __init__(self, conn, cluster, master_nodes):
+            if self._cache is not None:
+                for uuid, name in list(k8s_clusters.items()):
+                    nodes_info = self._cache.get(('cluster_nodes', uuid))
+                    if nodes_info is not None:
+                        self.clusters.update({uuid: ClusterNodes({'uuid': uuid, 'displayName': name}, nodes_info=nodes_info)})
+                        del k8s_clusters[uuid]
+
+            if k8s_clusters:
+                umsg.log(f"Resolving capacity for {len(k8s_clusters)} cluster(s)", level=logging.DEBUG)
+                node_index = NodeCapacityIndex(self._conn, list(k8s_clusters), master_nodes)
+
+                for uuid, name in k8s_clusters.items():
+                    self.clusters.update({uuid: ClusterNodes({'uuid': uuid, 'displayName': name}, node_index)})
+                    if self._cache is not None:
+                        self._cache.set(('cluster_nodes', uuid), [self.clusters[uuid].numCores, self.clusters[uuid].total_mhz])
+
+            return self.clusters[cluster_uuid]
+
+
+class LazyClusterDict(dict):
+    """Dict of cluster uuids to ClusterNodes which resolves missing clusters through a callback"""
+
+    def __init__(self, resolve):
+        super().__init__()
+        self._resolve = resolve
+
+    def __missing__(self, cluster_uuid):
+        if cluster_uuid is None:
+            raise KeyError(cluster_uuid)
+        return self._resolve(cluster_uuid)
+
+
+class NodeCapacityIndex():
+    """Index of the worker node cores and VCPU capacity for a set of clusters
+
+    VCPU capacities for every cluster are collected in a single multi-scope stats request, and
+    nodes are held in sets/dicts so membership checks are constant time.
+    """
+
+    def __init__(self, conn, cluster_uuids, master_nodes):
         self._conn = conn
-        self._uuid = cluster['uuid']
-        self.name = cluster['displayName']
         self._master_nodes = master_nodes
-        self.numCores, self.total_mhz = self._get_nodes_info()
-        
-    def _get_nodes_info(self):
-        total_cores = 0
-        worker_nodes = []
-        search = self._conn.get_supplychains(uuids=self._uuid, 
+        self.cluster_nodes = {uuid: self._get_worker_nodes(uuid) for uuid in cluster_uuids}
+        self.vcpu_capacity = self._get_vcpu_capacity(cluster_uuids) if cluster_uuids else {}
+
+    def _get_worker_nodes(self, cluster_uuid):
+        """Return a dict of active worker node uuids to their number of VCPUs for a cluster"""
+        worker_nodes = {}
+        search = self._conn.get_supplychains(uuids=cluster_uuid, 
                                               types=['VirtualMachine'], 
                                               detail='aspects',
                                               aspects=['virtualMachineAspect'],
@@ -405,37 +1379,988 @@ class ClusterNodes():
 
             for node in search_paged[0]['seMap']['VirtualMachine']['instances'].values():
                 if node['state'] == 'ACTIVE' and node['uuid'] not in self._master_nodes:
-                    total_cores += node['aspects']['virtualMachineAspect']['numVCPUs']
-                    worker_nodes.append(node['uuid'])
+                    worker_nodes[node['uuid']] = node['aspects']['virtualMachineAspect']['numVCPUs']
 
             del search_paged
 
-        total_mhz = self._get_cpu_info(worker_nodes)
-
-        return (total_cores, total_mhz)
+        return worker_nodes
 
-    def _get_cpu_info(self, worker_nodes):
-        cpu_speed = 0
+    def _get_vcpu_capacity(self, cluster_uuids):
+        """Return a dict of node uuids to VCPU capacity for every node in the clusters"""
+        vcpu_capacity = {}
                 
-        search_dto = {'scopes':[self._uuid],'period':{'statistics':[{'name':'VCPU'}]},'relatedType':'VirtualMachine'}
-        
-
+        search_dto = {'scopes':list(cluster_uuids),'period':{'statistics':[{'name':'VCPU'}]},'relatedType':'VirtualMachine'}
         search = self._conn.request(path='stats', method='POST', dto=json.dumps(search_dto), pager=True)
 
-
         while not search.complete:
 
             search_paged = search.next
             
             for node in search_paged:
-                if node['uuid'] in worker_nodes:
-                    
-                    for stat in node['stats'][0]['statistics']:
-                        if stat['name'] == 'VCPU':
-                            cpu_speed += stat['capacity']['total']
+                vcpu_capacity[node['uuid']] = sum(stat['capacity']['total'] for stat in node['stats'][0]['statistics'] if stat['name'] == 'VCPU')
 
             del search_paged
-        return cpu_speed
+        return vcpu_capacity
+
+
+class ClusterNodes():
+    __slots__ = ('_uuid', 'name', 'numCores', 'total_mhz')
+    
+    def __init__(self, cluster, node_index=None, nodes_info=None):
+        self._uuid = cluster['uuid']
+        self.name = cluster['displayName']
+        self.numCores, self.total_mhz = nodes_info if nodes_info else self._get_nodes_info(node_index)
+        
+    def _get_nodes_info(self, node_index):
+        worker_nodes = node_index.cluster_nodes.get(self._uuid, {})
+        total_cores = sum(worker_nodes.values())
+        total_mhz = sum(node_index.vcpu_capacity.get(node, 0) for node in worker_nodes)
+
+        return (total_cores, total_mhz)
+
+
+class TaskScheduler():
+    """Runs named tasks on a thread pool as soon as the tasks they run after have completed
+
+    add returns a Future for the task's result.  A task whose dependency failed fails with the
+    same exception without running.  The task graph, with the dependencies, state and duration
+    of every task, is logged at DEBUG level as tasks are added and by log_graph.
+    """
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self._lock = threading.Lock()
+        self.tasks = {}
+
+    def add(self, name, func, *args, after=()):
+        """Schedule func(*args) to run once every task named in after has completed, returning its Future"""
+        with self._lock:
+            if name in self.tasks:
+                return self.tasks[name]['future']
+            task = {'after': list(after), 'future': Future(), 'waiting': len(after), 'start': None, 'end': None}
+            self.tasks[name] = task
+            dependencies = [self.tasks[dependency]['future'] for dependency in after]
+
+        umsg.log(f"Task {name} added{f', runs after {list(after)}' if after else ''}", level=logging.DEBUG)
+        if not dependencies:
+            self._executor.submit(self._run, name, func, args)
+        for dependency in dependencies:
+            dependency.add_done_callback(lambda _, name=name, func=func, args=args: self._dependency_done(name, func, args))
+        return task['future']
+
+    def _dependency_done(self, name, func, args):
+        task = self.tasks[name]
+        with self._lock:
+            task['waiting'] -= 1
+            if task['waiting']:
+                return
+
+        for dependency in task['after']:
+            error = self.tasks[dependency]['future'].exception()
+            if error is not None:
+                umsg.log(f"Task {name} skipped, {dependency} failed", level=logging.DEBUG)
+                task['future'].set_exception(error)
+                return
+        self._executor.submit(self._run, name, func, args)
+
+    def _run(self, name, func, args):
+        task = self.tasks[name]
+        task['start'] = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception as error:
+            task['end'] = time.perf_counter()
+            umsg.log(error_handling(), level=logging.WARNING)
+            umsg.log(f"Task {name} failed", level=logging.WARNING)
+            task['future'].set_exception(error)
+        else:
+            task['end'] = time.perf_counter()
+            task['future'].set_result(result)
+
+    def log_graph(self):
+        """Log every task with its dependencies, state and duration at DEBUG level"""
+        if LOGLEVEL != 'DEBUG':
+            return
+
+        with self._lock:
+            tasks = dict(self.tasks)
+
+        for name, task in tasks.items():
+            if task['end'] is not None:
+                state = f"{'failed' if task['future'].exception() else 'done'} in {task['end'] - task['start']:.2f}s"
+            else:
+                state = 'running' if task['start'] is not None else 'waiting'
+            umsg.log(f"Task {name}: {state}, after {task['after']}", level=logging.DEBUG)
+
+
+class PageSizer():
+    """Sets the page size (``limit``) of paged API requests per query type
+
+    The query type is the first part of the resource path, ``search``, ``stats`` or
+    ``supplychains`` for the paged requests made by this script.  Configured sizes are used as is unless adaptive, in which case the size of
+    each query type starts at the configured size (or default_size) and is doubled after a fast,
+    small page that has more pages after it, or halved when a page takes longer than
+    target_latency seconds or is larger than max_bytes, staying between min_size and max_size.
+    Because follow-up pages reuse the query of the previous page, a new size applies from the
+    next page of the current pager.
+    """
+
+    LIMIT_RE = re.compile(r'(^|[?&])limit=\d+')
+    PAGED_TYPES = ('search', 'stats', 'supplychains')
+
+    def __init__(self, sizes=None, adaptive=False, default_size=100, min_size=20, max_size=500, target_latency=5.0,
+                 max_bytes=16*1024*1024):
+        self.sizes = dict(sizes) if sizes else {}
+        self.adaptive = adaptive
+        self.default_size = default_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        umsg.log(f"Page sizes: {self.sizes if self.sizes else 'server default'}"
+                 f"{f', adaptive between {min_size} and {max_size}' if adaptive else ''}", level=logging.INFO)
+
+    @staticmethod
+    def parse_sizes(value):
+        """Parse 'search=500:stats=200' (or a single size for every query type) into a dict"""
+        if not value:
+            return {}
+        if value.isdigit():
+            return {'*': int(value)}
+        return {key.strip(): int(size) for key, size in (item.split('=', 1) for item in value.split(':'))}
+
+    def get_size(self, query_type):
+        with self._lock:
+            if query_type in self.sizes:
+                return self.sizes[query_type]
+            if query_type not in self.PAGED_TYPES:
+                return None
+            if '*' in self.sizes:
+                return self.sizes['*']
+            if self.adaptive:
+                return self.default_size
+            return None
+
+    def set_query_limit(self, query, limit):
+        query = query or ''
+        if self.LIMIT_RE.search(query):
+            return self.LIMIT_RE.sub(lambda m: f'{m.group(1)}limit={limit}', query)
+        return f"{query}{'&' if query and query[-1] not in '?&' else ''}limit={limit}"
+
+    def observe(self, query_type, size, latency, response):
+        """Adjust the page size of query_type from the response time and payload of a page"""
+        length = len(response.content or b'')
+        with self._lock:
+            if latency > self.target_latency or length > self.max_bytes:
+                new_size = max(self.min_size, size // 2)
+            elif 'x-next-cursor' in response.headers and latency < self.target_latency / 2 and length < self.max_bytes / 2:
+                new_size = min(self.max_size, size * 2)
+            else:
+                return
+            if new_size != self.sizes.get(query_type, size):
+                umsg.log(f"Page size for {query_type}: {size} -> {new_size} ({latency:.2f}s, {length} bytes)", level=logging.INFO)
+            self.sizes[query_type] = new_size
+
+    def wrap(self, conn):
+        """Add the page size to every request made through conn"""
+        request = conn._request
+
+        def _request(method, resource, query='', data=None, **kwargs):
+            query_type = resource.lstrip('/').split('/')[0].split('?')[0]
+            size = self.get_size(query_type)
+            if size is None:
+                return request(method, resource, query=query, data=data, **kwargs)
+
+            start = time.perf_counter()
+            response = request(method, resource, query=self.set_query_limit(query, size), data=data, **kwargs)
+            if self.adaptive and response.status_code < 400:
+                self.observe(query_type, size, time.perf_counter() - start, response)
+            return response
+
+        conn._request = _request
+        return conn
+
+    def log_summary(self):
+        umsg.log(f"Final page sizes: {self.sizes if self.sizes else 'server default'}", level=logging.INFO)
+
+
+class RateLimiter():
+    """Shared token bucket rate limiter with retries, exponential backoff and jitter for API requests
+
+    Wrapping a connection routes every request made through it, and through copies of it made
+    for worker threads, through a single bucket.  The rate adapts AIMD style: it is halved when
+    the server responds with 429 or 5xx, lowered by 10% when a response takes longer than
+    target_latency, and grows back by roughly one request per second, every second, up to
+    max_rate.  Without an initial rate requests are not paced until the first throttled or slow
+    response, when pacing starts from the recently observed request rate.
+
+    Throttled and failed requests are retried up to max_retries times, sleeping a random time
+    up to backoff_base * 2 ** attempt seconds (capped at backoff_max), or the server's Retry-After.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, rate=None, max_rate=None, min_rate=0.5, target_latency=2.0, max_retries=5, backoff_base=0.5,
+                 backoff_max=60.0, run_metrics=None):
+        self.rate = float(rate) if rate else None
+        self.max_rate = float(max_rate) if max_rate else self.rate
+        self.min_rate = min_rate
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._run_metrics = run_metrics
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._recent = deque(maxlen=100)
+        self._random = random.Random()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate is None:
+                    self._recent.append(now)
+                    return
+                else:
+                    self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last_refill) * self.rate)
+                    self._last_refill = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._recent.append(now)
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _observed_rate(self):
+        if len(self._recent) < 2 or self._recent[-1] <= self._recent[0]:
+            return None
+        return (len(self._recent) - 1) / (self._recent[-1] - self._recent[0])
+
+    def _set_rate(self, rate, reason):
+        rate = max(self.min_rate, rate)
+        if self.max_rate:
+            rate = min(self.max_rate, rate)
+        if self.rate is None or abs(rate - self.rate) >= 0.01:
+            umsg.log(f"API request rate {self.rate if self.rate is None else round(self.rate, 2)} -> {rate:.2f}/s ({reason})",
+                     level=logging.DEBUG)
+        self.rate = rate
+
+    def on_success(self, latency):
+        with self._lock:
+            if self.target_latency and latency > self.target_latency:
+                if time.monotonic() - self._last_decrease >= self.DECREASE_INTERVAL:
+                    self._last_decrease = time.monotonic()
+                    rate = self.rate if self.rate is not None else (self._observed_rate() or self.min_rate)
+                    self._set_rate(rate * 0.9, f'latency {latency:.2f}s')
+            elif self.rate is not None and (not self.max_rate or self.rate < self.max_rate):
+                self._set_rate(self.rate + 1 / self.rate, 'recovering')
+
+    def on_throttle(self, reason, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            # requests already in flight when the server pushed back only count once
+            if now - self._last_decrease >= self.DECREASE_INTERVAL:
+                self._last_decrease = now
+                if self.rate is None:
+                    observed = self._observed_rate()
+                    rate = observed / 2 if observed else self.min_rate
+                else:
+                    rate = self.rate / 2
+                self._set_rate(rate, reason)
+                self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after:
+            return min(self.backoff_max, retry_after)
+        return self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def wrap(self, conn):
+        """Send every request made through conn via the rate limiter"""
+        request = conn._request
+
+        def _request(method, resource, query='', data=None, **kwargs):
+            attempt = 0
+            while True:
+                self.acquire()
+                start = time.perf_counter()
+                try:
+                    response = request(method, resource, query=query, data=data, **kwargs)
+                except vc.VMTConnectionError:
+                    if attempt >= self.max_retries:
+                        raise
+                    reason, retry_after = 'connection error', None
+                else:
+                    if response.status_code not in self.RETRY_STATUS:
+                        self.on_success(time.perf_counter() - start)
+                        return response
+                    if attempt >= self.max_retries:
+                        return response
+                    reason, retry_after = f'HTTP {response.status_code}', self._retry_after(response)
+
+                self.on_throttle(reason, retry_after)
+                wait = self.backoff(attempt, retry_after)
+                attempt += 1
+                if self._run_metrics:
+                    self._run_metrics.count('api_retries')
+                umsg.log(f"{reason} from {method} {resource}, retry {attempt}/{self.max_retries} in {wait:.2f}s", level=logging.WARNING)
+                time.sleep(wait)
+
+        conn._request = _request
+        return conn
+
+
+class RunMetrics():
+    """Per-phase timing and API instrumentation for a single run
+
+    Time spent inside each phase (namespace discovery, stats, cluster capacity, output, email) is
+    recorded per thread, so ``busy`` is the summed time across worker threads while ``wall`` is
+    the span from the first start to the last end of the phase.  Nested phases pause their
+    parent.  When a connection is instrumented, every API request is attributed to the phase
+    active on the calling thread along with its latency, page count, errors and response bytes.
+    """
+
+    LATENCY_QUANTILES = [0.5, 0.95, 0.99]
+
+    def __init__(self, slowest=10):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._slowest_size = slowest
+        self._slowest = []
+        self._counters = {}
+        self.phases = {}
+        self.instances = {}
+        self.started = time.time()
+        self.finished = None
+
+    def _phase_stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'busy': 0.0, 'first_start': None, 'last_end': None, 'requests': 0,
+                                 'pages': 0, 'errors': 0, 'bytes': 0, 'latencies': array('d')}
+        return self.phases[name]
+
+    def _current_phase(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1][0] if stack else 'other'
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as part of the named phase"""
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        stack = self._local.stack
+        now = time.perf_counter()
+
+        if stack:
+            parent, parent_start = stack[-1]
+            with self._lock:
+                self._phase_stats(parent)['busy'] += now - parent_start
+
+        stack.append([name, now])
+        with self._lock:
+            stats = self._phase_stats(name)
+            if stats['first_start'] is None:
+                stats['first_start'] = now
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            _, start = stack.pop()
+            with self._lock:
+                stats['busy'] += end - start
+                stats['last_end'] = end if stats['last_end'] is None else max(stats['last_end'], end)
+            if stack:
+                stack[-1][1] = end
+
+    def instrument(self, conn):
+        """Wrap conn._request so every API call made through conn (or copies of it) is recorded"""
+        request = conn._request
+
+        def _request(method, resource, query='', data=None, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = request(method, resource, query=query, data=data, **kwargs)
+            except Exception:
+                self.record_request(time.perf_counter() - start, error=True)
+                raise
+
+            self.record_request(time.perf_counter() - start, page='cursor=' in str(query or ''),
+                                size=len(response.content or b''), error=response.status_code >= 400)
+            return response
+
+        conn._request = _request
+        return conn
+
+    def record_request(self, seconds, page=False, size=0, error=False):
+        with self._lock:
+            stats = self._phase_stats(self._current_phase())
+            stats['requests'] += 1
+            stats['pages'] += page
+            stats['errors'] += error
+            stats['bytes'] += size
+            stats['latencies'].append(seconds)
+
+    def record_namespace(self, name, cluster, seconds):
+        """Track the slowest namespaces (or batches) to fetch"""
+        with self._lock:
+            item = (seconds, name, cluster)
+            if len(self._slowest) < self._slowest_size:
+                heapq.heappush(self._slowest, item)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_instance(self, name, summary=None, error=None):
+        """Record the run summary of a Turbonomic instance collected in a worker process, or why it failed"""
+        with self._lock:
+            self.instances[name] = {'summary': summary, 'error': error}
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.time()
+        return self
+
+    @classmethod
+    def _latency_summary(cls, latencies):
+        if not len(latencies):
+            return {}
+        values = np.percentile(np.frombuffer(latencies, dtype=np.float64), [q * 100 for q in cls.LATENCY_QUANTILES])
+        return {f'p{int(q * 100)}': round(float(v), 6) for q, v in zip(cls.LATENCY_QUANTILES, values)}
+
+    def summary(self):
+        """Return the run summary as a JSON serializable dict"""
+        finished = self.finished if self.finished else time.time()
+        with self._lock:
+            phases = {name: {'busy_seconds': round(stats['busy'], 6),
+                             'wall_seconds': round((stats['last_end'] or stats['first_start']) - stats['first_start'], 6),
+                             'requests': stats['requests'],
+                             'pages': stats['pages'],
+                             'errors': stats['errors'],
+                             'bytes': stats['bytes'],
+                             'latency_seconds': self._latency_summary(stats['latencies'])}
+                      for name, stats in self.phases.items() if stats['first_start'] is not None or stats['requests']}
+            for name, stats in self.phases.items():
+                if stats['first_start'] is None and stats['requests']:
+                    phases[name]['wall_seconds'] = None
+            latencies = array('d')
+            for stats in self.phases.values():
+                latencies.extend(stats['latencies'])
+            slowest = sorted(self._slowest, reverse=True)
+            counters = dict(self._counters)
+            instances = dict(self.instances)
+
+        summary = {'started': datetime.datetime.utcfromtimestamp(self.started).isoformat(timespec='seconds') + 'Z',
+                'duration_seconds': round(finished - self.started, 6),
+                'counters': counters,
+                'api': {'requests': sum(p['requests'] for p in phases.values()),
+                        'pages': sum(p['pages'] for p in phases.values()),
+                        'errors': sum(p['errors'] for p in phases.values()),
+                        'bytes': sum(p['bytes'] for p in phases.values()),
+                        'latency_seconds': self._latency_summary(latencies)},
+                'phases': phases,
+                'slowest_namespaces': [{'namespace': name, 'cluster': cluster, 'seconds': round(seconds, 6)}
+                                       for seconds, name, cluster in slowest]}
+        if instances:
+            summary['instances'] = instances
+        return summary
+
+    def log_summary(self):
+        summary = self.summary()
+        api = summary['api']
+        umsg.log(f"Run completed in {summary['duration_seconds']:.2f}s, {api['requests']} API requests "
+                 f"({api['pages']} pages, {api['errors']} errors, {api['bytes']} bytes)", level=logging.INFO)
+        for name, stats in summary['phases'].items():
+            wall = f"{stats['wall_seconds']:.2f}s" if stats['wall_seconds'] is not None else 'n/a'
+            umsg.log(f"Phase {name}: wall {wall}, busy {stats['busy_seconds']:.2f}s, {stats['requests']} requests, "
+                     f"{stats['errors']} errors, latency {stats['latency_seconds']}", level=logging.INFO)
+        for name, instance in summary.get('instances', {}).items():
+            if instance['summary']:
+                umsg.log(f"Instance {name}: {instance['summary']['duration_seconds']:.2f}s, {instance['summary']['api']['requests']} requests, "
+                         f"{instance['summary']['counters'].get('namespaces', 0)} namespace(s)", level=logging.INFO)
+            else:
+                umsg.log(f"Instance {name}: failed, {instance['error']}", level=logging.ERROR)
+        for item in summary['slowest_namespaces']:
+            umsg.log(f"Slow namespace {item['namespace']} ({item['cluster']}): {item['seconds']:.2f}s", level=logging.DEBUG)
+        return summary
+
+    def write_summary(self, filename):
+        with open(filename, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+        umsg.log(f"Run summary written to {filename}", level=logging.INFO)
+
+    def write_prometheus(self, filename):
+        """Write the summary in the Prometheus text exposition format for the node_exporter textfile collector"""
+        summary = self.summary()
+        lines = ['# HELP namespace_util_run_duration_seconds Duration of the last run.',
+                 '# TYPE namespace_util_run_duration_seconds gauge',
+                 f"namespace_util_run_duration_seconds {summary['duration_seconds']}",
+                 '# HELP namespace_util_last_run_timestamp_seconds Unix time the last run finished.',
+                 '# TYPE namespace_util_last_run_timestamp_seconds gauge',
+                 f"namespace_util_last_run_timestamp_seconds {self.finished if self.finished else time.time():.0f}"]
+
+        for metric, key, help_text in [('phase_duration_seconds', 'wall_seconds', 'Wall time of each phase.'),
+                                       ('phase_busy_seconds', 'busy_seconds', 'Time spent in each phase summed across threads.'),
+                                       ('api_requests_total', 'requests', 'API requests made in each phase.'),
+                                       ('api_pages_total', 'pages', 'Follow-up pages requested in each phase.'),
+                                       ('api_errors_total', 'errors', 'Failed API requests in each phase.'),
+                                       ('api_response_bytes_total', 'bytes', 'API response bytes received in each phase.')]:
+            lines.append(f'# HELP namespace_util_{metric} {help_text}')
+            lines.append(f"# TYPE namespace_util_{metric} {'gauge' if metric.endswith('seconds') else 'counter'}")
+            for name, stats in summary['phases'].items():
+                if stats[key] is not None:
+                    lines.append(f'namespace_util_{metric}{{phase="{name}"}} {stats[key]}')
+
+        lines.append('# HELP namespace_util_api_latency_seconds API request latency quantiles.')
+        lines.append('# TYPE namespace_util_api_latency_seconds gauge')
+        for quantile in self.LATENCY_QUANTILES:
+            value = summary['api']['latency_seconds'].get(f'p{int(quantile * 100)}')
+            if value is not None:
+                lines.append(f'namespace_util_api_latency_seconds{{quantile="{quantile}"}} {value}')
+
+        for name, value in summary['counters'].items():
+            lines.append(f'# TYPE namespace_util_{name}_total counter')
+            lines.append(f'namespace_util_{name}_total {value}')
+
+        if summary.get('instances'):
+            lines.append('# HELP namespace_util_instance_success Whether each Turbonomic instance was collected.')
+            lines.append('# TYPE namespace_util_instance_success gauge')
+            for name, instance in summary['instances'].items():
+                lines.append(f'namespace_util_instance_success{{instance="{name}"}} {0 if instance["error"] else 1}')
+            for metric, help_text in [('instance_duration_seconds', 'Time taken to collect each Turbonomic instance.'),
+                                      ('instance_api_requests_total', 'API requests made to each Turbonomic instance.')]:
+                lines.append(f'# HELP namespace_util_{metric} {help_text}')
+                lines.append(f"# TYPE namespace_util_{metric} {'gauge' if metric.endswith('seconds') else 'counter'}")
+                for name, instance in summary['instances'].items():
+                    if instance['summary']:
+                        value = instance['summary']['duration_seconds'] if metric.endswith('seconds') else instance['summary']['api']['requests']
+                        lines.append(f'namespace_util_{metric}{{instance="{name}"}} {value}')
+
+        # write then rename so the textfile collector never reads a partial file
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_filename, filename)
+        umsg.log(f"Prometheus metrics written to {filename}", level=logging.INFO)
+
+
+class ResponseCache():
+    """Persistent SQLite cache of API results with a TTL and size based eviction
+
+    Entries are keyed by a hash of the key parts (e.g. entity uuid, commodity list and date
+    range) and written as they are stored, so a failed run can be resumed from the cache.
+    Once the cache grows past max_size bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, ttl=86400, max_size=512*1024*1024):
+        self._path = path
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._db.execute('DELETE FROM cache WHERE created < ?', (time.time() - self._ttl,))
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        umsg.log(f"Using response cache {path} ({self._size} bytes, TTL {ttl}s, max {max_size} bytes)", level=logging.INFO)
+
+    @staticmethod
+    def _hash_key(key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        hashed_key = self._hash_key(key)
+
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM cache WHERE key = ?', (hashed_key,)).fetchone()
+
+            if row is None or row[1] < time.time() - self._ttl:
+                self.misses += 1
+                return None
+
+            self._db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), hashed_key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entries if the cache is full"""
+        hashed_key = self._hash_key(key)
+        data = json.dumps(value)
+        now = time.time()
+
+        with self._lock:
+            old = self._db.execute('SELECT size FROM cache WHERE key = ?', (hashed_key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)', (hashed_key, data, len(data), now, now))
+            self._size += len(data) - (old[0] if old else 0)
+
+            if self._size > self._max_size:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache is below 90% of its max size"""
+        target = self._max_size * 0.9
+        evicted = 0
+
+        for key, size in self._db.execute('SELECT key, size FROM cache ORDER BY accessed').fetchall():
+            if self._size <= target:
+                break
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._size -= size
+            evicted += 1
+        umsg.log(f"Evicted {evicted} entries from the response cache", level=logging.DEBUG)
+
+    def close(self):
+        umsg.log(f"Response cache hits: {self.hits}, misses: {self.misses}", level=logging.INFO)
+        self._db.close()
+
+
+class AggregateStore():
+    """Persistent SQLite store of daily namespace stat aggregates
+
+    Each namespace's stats for a day are collapsed to a single sample (the day's average,
+    peak and latest capacity), so a report built from the store matches the daily rollups a
+    monthly stats request returns.  Days are stored with INSERT OR REPLACE so rerunning a
+    daily collection never double counts.
+    """
+
+    def __init__(self, path, retention_days=93):
+        self._path = path
+        self._retention_days = retention_days
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS namespaces (uuid TEXT PRIMARY KEY, name TEXT, cluster_uuid TEXT, cluster TEXT, tags TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS daily_stats (uuid TEXT, day TEXT, commodity TEXT, count INTEGER, sum REAL, peak REAL, capacity REAL, '
+                         'PRIMARY KEY (uuid, day, commodity))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS daily_stats_day ON daily_stats (day)')
+        umsg.log(f"Using aggregate store {path}", level=logging.INFO)
+
+    def add_namespace_day(self, namespace, day):
+        """Merge a NamepaceEntity's stats for day into the store"""
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT OR REPLACE INTO namespaces VALUES (?, ?, ?, ?, ?)',
+                             (namespace.uuid, namespace.name, namespace.cluster_uuid, namespace.cluster, json.dumps(namespace.tags)))
+            for commodity, stats in namespace.stats.items():
+                self._db.execute('INSERT OR REPLACE INTO daily_stats VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (namespace.uuid, day, commodity, 1, stats['sum']/stats['count'], stats['peak'], stats['capacity']))
+            self._db.execute('COMMIT')
+
+    def count_days(self, start_day, end_day):
+        """Return the number of days with stored aggregates between start_day and end_day"""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(DISTINCT day) FROM daily_stats WHERE day BETWEEN ? AND ?', (start_day, end_day)).fetchone()[0]
+
+    def get_namespaces(self, start_day, end_day):
+        """Generator of namespaces with aggregates between start_day and end_day, in the shape of search results"""
+        with self._lock:
+            rows = self._db.execute('SELECT uuid, name, cluster_uuid, cluster, tags FROM namespaces n WHERE EXISTS '
+                                    '(SELECT 1 FROM daily_stats d WHERE d.uuid = n.uuid AND d.day BETWEEN ? AND ?) ORDER BY name',
+                                    (start_day, end_day)).fetchall()
+
+        for uuid, name, cluster_uuid, cluster, tags in rows:
+            yield {'uuid': uuid,
+                   'displayName': name,
+                   'tags': json.loads(tags),
+                   'providers': [{'className': 'ContainerPlatformCluster', 'uuid': cluster_uuid, 'displayName': cluster}] if cluster_uuid else []}
+
+    def get_stats(self, uuid, start_day, end_day):
+        """Return the stats for a namespace between start_day and end_day in the form built by NamepaceEntity.summarize_stats"""
+        with self._lock:
+            rows = self._db.execute('SELECT commodity, day, sum/count, peak, capacity FROM daily_stats '
+                                    'WHERE uuid = ? AND day BETWEEN ? AND ? ORDER BY commodity, day',
+                                    (uuid, start_day, end_day)).fetchall()
+
+        samples = {}
+        for commodity, day, value, peak, capacity in rows:
+            commodity_samples = samples.setdefault(commodity, [array('d'), array('d'), None])
+            commodity_samples[0].append(value)
+            commodity_samples[1].append(peak)
+            # The capacity of the latest day is reported, as in NamepaceEntity.add_stats
+            if commodity_samples[2] is None or day >= commodity_samples[2][0]:
+                commodity_samples[2] = (day, capacity)
+
+        return {commodity: NamepaceEntity.summarize_samples(np.frombuffer(values), np.frombuffer(peaks), capacity)
+                for commodity, (values, peaks, (_, capacity)) in samples.items()}
+
+    def prune(self):
+        """Delete aggregates older than the retention period"""
+        oldest = (datetime.date.today() - datetime.timedelta(days=self._retention_days)).isoformat()
+
+        with self._lock:
+            self._db.execute('DELETE FROM daily_stats WHERE day < ?', (oldest,))
+            self._db.execute('DELETE FROM namespaces WHERE uuid NOT IN (SELECT DISTINCT uuid FROM daily_stats)')
+
+    def close(self):
+        self._db.close()
+
+
+class RunHistoryStore():
+    """Persistent SQLite store of each report run's namespace stats, used for month over month deltas
+
+    A run is identified by its report period.  A namespace's stats are stored as a single blob
+    of doubles, every CommodityStats field of every commodity in the run's commodity order, under
+    a (period, uuid) primary key so the previous run is joined by uuid with an indexed lookup.
+    A run is written in a single transaction which replaces any earlier run of the same period,
+    and only the latest retention runs are kept.
+    """
+    FIELDS = CommodityStats.__slots__
+
+    def __init__(self, path, retention=13):
+        self._path = path
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._period = None
+        self._commodities = None
+        self._previous = None
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs (period TEXT PRIMARY KEY, commodities TEXT, created REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS run_stats (period TEXT, uuid TEXT, stats BLOB, PRIMARY KEY (period, uuid)) WITHOUT ROWID')
+        umsg.log(f"Using run history {path}", level=logging.INFO)
+
+    def start_run(self, period, commodities):
+        """Start storing the run of period, returning the period of the previous run or None if there is none"""
+        with self._lock:
+            row = self._db.execute('SELECT period, commodities FROM runs WHERE period < ? ORDER BY period DESC LIMIT 1', (period,)).fetchone()
+            self._previous = (row[0], json.loads(row[1])) if row else None
+            self._period, self._commodities = period, list(commodities)
+
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM run_stats WHERE period = ?', (period,))
+            self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)', (period, json.dumps(self._commodities), time.time()))
+
+        return self._previous[0] if self._previous else None
+
+    def add_namespace(self, namespace):
+        """Store a NamepaceEntity's stats in the current run, commodities without stats as NaN"""
+        values = array('d')
+        for commodity in self._commodities:
+            stats = namespace.stats.get(commodity)
+            values.extend(math.nan if stats is None or stats[field] is None else float(stats[field]) for field in self.FIELDS)
+
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO run_stats VALUES (?, ?, ?)', (self._period, namespace.uuid, values.tobytes()))
+
+    def get_previous_stats(self, uuid):
+        """Return a namespace's stats in the previous run as a dict of commodity to CommodityStats, or None"""
+        if self._previous is None:
+            return None
+
+        previous_period, commodities = self._previous
+        with self._lock:
+            row = self._db.execute('SELECT stats FROM run_stats WHERE period = ? AND uuid = ?', (previous_period, uuid)).fetchone()
+        if row is None:
+            return None
+
+        values = array('d')
+        values.frombytes(row[0])
+        stats = {}
+        for index, commodity in enumerate(commodities):
+            fields = values[index * len(self.FIELDS):(index + 1) * len(self.FIELDS)]
+            if not math.isnan(fields[0]):
+                stats[commodity] = CommodityStats(**dict(zip(self.FIELDS, fields)))
+        return stats
+
+    def finish_run(self, complete=True):
+        """Commit the current run, or discard it if it is not complete, and prune the runs past retention"""
+        with self._lock:
+            if not complete:
+                self._db.execute('ROLLBACK')
+                umsg.log(f"Discarded the incomplete run of {self._period} from the run history", level=logging.WARNING)
+                return
+
+            self._db.execute('COMMIT')
+            expired = [row[0] for row in self._db.execute('SELECT period FROM runs ORDER BY period DESC LIMIT -1 OFFSET ?', (self._retention,))]
+            for period in expired:
+                self._db.execute('DELETE FROM run_stats WHERE period = ?', (period,))
+                self._db.execute('DELETE FROM runs WHERE period = ?', (period,))
+            count = self._db.execute('SELECT COUNT(*) FROM run_stats WHERE period = ?', (self._period,)).fetchone()[0]
+        umsg.log(f"Stored {count} namespace(s) for {self._period} in the run history, pruned {len(expired)} run(s)", level=logging.INFO)
+
+    def close(self):
+        self._db.close()
+
+
+class ReportService():
+    """Serves reports over HTTP from a NamespaceTopology kept warm by a background refresh
+
+    The namespaces, their stats and the cluster capacities are held in memory and refreshed every
+    refresh_interval seconds, only fetching the stats of new namespaces, so a report is produced
+    without any API request.  List parameters are separated by a colon ':' like the configmap.
+
+    GET /report   cluster (names or uuids) and tag (name=value) select the namespaces, tags, commodities
+                  and metrics the columns, and format is csv, csv.gz, xlsx, parquet or json
+    GET /status   JSON summary of the warm topology and the last refresh
+    GET /healthz  200 once the first refresh has completed, 503 until then
+    """
+    CONTENT_TYPES = {'csv': 'text/csv',
+                     'csv.gz': 'application/gzip',
+                     'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                     'parquet': 'application/vnd.apache.parquet',
+                     'json': 'application/json'}
+
+    def __init__(self, topology, tags=None, refresh_interval=900, host='0.0.0.0', port=8080):
+        self.topology = topology
+        self.tags = tags
+        self.refresh_interval = refresh_interval
+        self._ready = threading.Event()
+        self.status = {'ready': False, 'namespaces': 0, 'clusters': 0, 'period': None, 'last_refresh': None,
+                       'refresh_seconds': None, 'refreshed_namespaces': 0, 'refresh_errors': 0, 'reports': 0}
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+
+    def serve_forever(self):
+        threading.Thread(target=self._refresh_loop, name='refresh', daemon=True).start()
+        umsg.log(f"Serving reports on port {self._httpd.server_address[1]}, refreshing every {self.refresh_interval}s", level=logging.INFO)
+        self._httpd.serve_forever()
+
+    def _refresh_loop(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                fetched = self.topology.refresh()
+            except Exception:
+                umsg.log(error_handling(), level=logging.ERROR)
+                umsg.log("Cannot refresh the topology, serving the previous one", level=logging.ERROR)
+                self.status['refresh_errors'] += 1
+            else:
+                seconds = time.perf_counter() - start
+                self.status.update({'ready': True,
+                                    'namespaces': len(self.topology.namespaces),
+                                    'clusters': len({x.cluster_uuid for x in self.topology.namespaces.values() if x.cluster_uuid}),
+                                    'period': [self.topology._startDate, self.topology._endDate],
+                                    'last_refresh': datetime.datetime.now().isoformat(timespec='seconds'),
+                                    'refresh_seconds': round(seconds, 3),
+                                    'refreshed_namespaces': fetched})
+                self._ready.set()
+                umsg.log(f"Refreshed {self.status['namespaces']} namespace(s) in {seconds:.2f}s, fetching {fetched}", level=logging.INFO)
+
+            time.sleep(max(0, self.refresh_interval - (time.perf_counter() - start)))
+
+    @staticmethod
+    def _split(params, name):
+        return [x for x in params[name].split(':') if x] if params.get(name) else None
+
+    @staticmethod
+    def _select(namespaces, clusters=None, tag_filters=None):
+        """Return the namespaces in any of clusters with, for each tag filtered on, any of its values"""
+        tag_values = {}
+        for tag_filter in tag_filters or []:
+            name, equals, value = tag_filter.partition('=')
+            if not equals:
+                raise ValueError(f"Tag filter {tag_filter} is not in the format name=value")
+            tag_values.setdefault(name, set()).add(value)
+
+        return [namespace for namespace in namespaces
+                if (not clusters or namespace.cluster in clusters or namespace.cluster_uuid in clusters)
+                and all(values.intersection(namespace.tags.get(name) or []) for name, values in tag_values.items())]
+
+    @classmethod
+    def filetype(cls, params):
+        """Return the report format of the request parameters, raising ValueError for one that cannot be served"""
+        filetype = params.get('format', 'csv').lower()
+        if filetype not in cls.CONTENT_TYPES:
+            raise ValueError(f"Unknown format {filetype}, valid options are {list(cls.CONTENT_TYPES)}")
+        if filetype == 'parquet' and pa is None:
+            raise ValueError('The parquet format requires the pyarrow package')
+        return filetype
+
+    def report(self, params):
+        """Return the report for the request parameters, raising ValueError for an invalid parameter"""
+        filetype = self.filetype(params)
+
+        view = self.topology.view(self._split(params, 'commodities'), self._split(params, 'metrics'),
+                                  self._split(params, 'tags') if 'tags' in params else self.tags)
+        namespaces = self._select(view.namespaces.values(), self._split(params, 'cluster'), self._split(params, 'tag'))
+
+        if filetype == 'json':
+            rows = view.output_rows(namespaces)
+            return json.dumps({'headers': next(rows), 'rows': list(rows)}).encode()
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, f'namespaceReport.{filetype}')
+            view.output_to_file(filename, filetype, namespaces)
+            with open(filename, 'rb') as report_file:
+                return report_file.read()
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                umsg.log(f"{self.address_string()} {format % args}", level=logging.DEBUG)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+                if url.path == '/healthz':
+                    return self._send(200 if service._ready.is_set() else 503, {'ready': service._ready.is_set()})
+                if url.path == '/status':
+                    return self._send(200, service.status)
+                if url.path != '/report':
+                    return self._send(404, {'error': f"Unknown path {url.path}"})
+                # An unsupported format is rejected without waiting for the topology
+                try:
+                    filetype = service.filetype(params)
+                except ValueError as error:
+                    return self._send(400, {'error': str(error)})
+                if not service._ready.is_set():
+                    return self._send(503, {'error': 'The topology is still being collected'})
+
+                start = time.perf_counter()
+                try:
+                    body = service.report(params)
+                except ValueError as error:
+                    return self._send(400, {'error': str(error)})
+                except Exception:
+                    umsg.log(error_handling(), level=logging.ERROR)
+                    return self._send(500, {'error': 'Cannot create the report'})
+
+                service.status['reports'] += 1
+                umsg.log(f"Served {filetype} report for {params} in {time.perf_counter() - start:.2f}s", level=logging.INFO)
+                self._send(200, body, service.CONTENT_TYPES[filetype],
+                           {'Content-Disposition': f'attachment; filename="namespaceReport_{datetime.date.today().isoformat()}.{filetype}"'}
+                           if filetype != 'json' else None)
+
+            def _send(self, status, body, content_type='application/json', headers=None):
+                body = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
 
 
 def error_handling():
@@ -445,6 +2370,188 @@ def error_handling():
 
 
 
+def write_run_metrics(run_metrics, summary_path=None, prom_path=None):
+    """Log the run summary and write it to the configured JSON and Prometheus textfile paths"""
+    run_metrics.finish()
+    run_metrics.log_summary()
+
+    try:
+        if summary_path:
+            run_metrics.write_summary(summary_path)
+        if prom_path:
+            run_metrics.write_prometheus(prom_path)
+    except OSError:
+        umsg.log(error_handling(), level=logging.ERROR)
+        umsg.log("Cannot write run metrics", level=logging.ERROR)
+
+
+def get_instances():
+    """Return the Turbonomic instances listed in TURBO_INSTANCES, separated by a colon ':'
+
+    Each instance reads its host and credentials from TURBO_HOST_<NAME>, TURBO_USER_<NAME> and
+    TURBO_PASS_<NAME>, with the name upper cased and other characters replaced by '_'.  The
+    credentials fall back to TURBO_USER and TURBO_PASS.
+    """
+    instances = []
+
+    for name in filter(None, os.getenv('TURBO_INSTANCES', '').split(':')):
+        env_name = re.sub(r'[^A-Z0-9]', '_', name.upper())
+        host = os.getenv(f'TURBO_HOST_{env_name}')
+        if not host:
+            umsg.log(f"TURBO_HOST_{env_name} is required for instance {name}", level=logging.ERROR)
+            sys.exit(1)
+        instances.append({'name': name,
+                          'host': host,
+                          'username': os.getenv(f'TURBO_USER_{env_name}', os.getenv('TURBO_USER')),
+                          'password': os.getenv(f'TURBO_PASS_{env_name}', os.getenv('TURBO_PASS'))})
+    return instances
+
+
+def instance_path(path, instance):
+    """Return path with the instance name added before its extension, giving each instance its own file"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{instance}{ext}'
+
+
+def create_connection(host, username, password, run_metrics, limiter_params, pager_params=None):
+    """Create a Connection to Turbonomic with page sizing, instrumentation and rate limiting
+
+    Returns the connection and its PageSizer, or None when page sizes are not configured.
+    """
+    vmt = vc.Connection(host=host, username=username, password=password)
+    page_sizer = PageSizer(**pager_params) if pager_params else None
+    if page_sizer:
+        page_sizer.wrap(vmt)
+    run_metrics.instrument(vmt)
+    RateLimiter(run_metrics=run_metrics, **limiter_params).wrap(vmt)
+    return vmt, page_sizer
+
+
+def collect_instance(instance, config, filename, results):
+    """Collect one Turbonomic instance into a partial result, run in a worker process per instance
+
+    The cache and aggregate store files get the instance name added so instances never share
+    entries.  The instance's run summary, or the error that stopped it, is put on results.
+    """
+    umsg.set_attr('msg_prefix', instance['name'])
+    run_metrics = RunMetrics()
+
+    try:
+        topology_params = dict(config['topology'], instance=instance['name'], run_metrics=run_metrics)
+        cache = aggregate_store = None
+
+        if config['cache']:
+            cache = ResponseCache(**dict(config['cache'], path=instance_path(config['cache']['path'], instance['name'])))
+            topology_params.update({'cache': cache})
+
+        if config['aggregate']:
+            aggregate_store = AggregateStore(**dict(config['aggregate'], path=instance_path(config['aggregate']['path'], instance['name'])))
+            if config['mode'] != 'daily':
+                topology_params.update({'aggregate_store': aggregate_store})
+
+        vmt, page_sizer = create_connection(instance['host'], instance['username'], instance['password'], run_metrics,
+                                            config['limiter'], config['pager'])
+        ns_Top = NamespaceTopology(vmt, **topology_params)
+
+        if config['mode'] == 'daily':
+            ns_Top.store_daily_stats(aggregate_store)
+        else:
+            with run_metrics.phase('output'):
+                ns_Top.output_partial(filename)
+
+        if aggregate_store:
+            aggregate_store.close()
+        if cache:
+            cache.close()
+        if page_sizer:
+            page_sizer.log_summary()
+        results.put((instance['name'], run_metrics.finish().summary(), None))
+
+    except Exception:
+        error = error_handling()
+        umsg.log(error, level=logging.ERROR)
+        umsg.log(f"Cannot collect instance {instance['name']} from {instance['host']}", level=logging.ERROR)
+        results.put((instance['name'], None, error))
+
+
+def collect_instances(instances, config, filepath, run_metrics, timeout=None):
+    """Collect every instance in its own worker process, returning the partial results of those that completed
+
+    Instances are collected in parallel, so a slow or failing instance does not hold up the
+    others.  Instances still running after timeout seconds are stopped and left out of the report.
+    """
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    processes = {}
+    completed = set()
+
+    for instance in instances:
+        filename = os.path.join(filepath, f"namespacePartial_{instance['name']}.jsonl")
+        process = context.Process(target=collect_instance, args=(instance, config, filename, results),
+                                  name=f"namespace-util-{instance['name']}")
+        process.start()
+        processes[instance['name']] = (process, filename)
+    umsg.log(f"Collecting {len(instances)} instance(s) in parallel: {list(processes)}", level=logging.INFO)
+
+    deadline = time.monotonic() + timeout if timeout else None
+    pending = set(processes)
+    exited = set()
+
+    while pending:
+        try:
+            name, summary, error = results.get(timeout=1)
+        except queue.Empty:
+            # a worker still not reported a second after it exited (e.g. killed for running out of memory) failed
+            for name in [name for name in pending if name in exited]:
+                pending.discard(name)
+                run_metrics.add_instance(name, error=f'worker exited with code {processes[name][0].exitcode}')
+                umsg.log(f"Instance {name} worker exited with code {processes[name][0].exitcode}", level=logging.ERROR)
+            exited.update(name for name in pending if not processes[name][0].is_alive())
+
+            if deadline and time.monotonic() > deadline:
+                for name in pending:
+                    processes[name][0].terminate()
+                    run_metrics.add_instance(name, error=f'timed out after {timeout}s')
+                    umsg.log(f"Instance {name} timed out after {timeout}s and is left out of the report", level=logging.ERROR)
+                pending.clear()
+            continue
+
+        pending.discard(name)
+        run_metrics.add_instance(name, summary=summary, error=error)
+        if not error:
+            completed.add(name)
+            umsg.log(f"Instance {name} collected in {summary['duration_seconds']:.2f}s", level=logging.INFO)
+
+    for name, (process, filename) in processes.items():
+        process.join()
+        if name in completed:
+            continue
+        # a worker stopped part way through leaves its temporary output behind
+        for partial in (filename, f'{filename}.{process.pid}.tmp'):
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    return [filename for name, (_, filename) in processes.items() if name in completed and os.path.exists(filename)]
+
+
+def shard_partial_paths(path, shard_count):
+    """Return the partial result file of each shard of this month's sharded run, in shard order"""
+    run = datetime.date.today().strftime('%Y-%m')
+    return [os.path.join(path, f'namespacePartial_{run}_shard-{index}-of-{shard_count}.jsonl') for index in range(shard_count)]
+
+
+def wait_for_partials(filenames, timeout=0, interval=10):
+    """Wait up to timeout seconds for every partial result to be written, returning those still missing"""
+    deadline = time.monotonic() + timeout
+
+    while True:
+        missing = [filename for filename in filenames if not os.path.exists(filename)]
+        if not missing or time.monotonic() >= deadline:
+            return missing
+        umsg.log(f"Waiting for {len(missing)} of {len(filenames)} partial result(s)", level=logging.INFO)
+        time.sleep(max(0, min(interval, deadline - time.monotonic())))
+
+
 def main():
 
     ## Variables set from environment
@@ -478,40 +2585,311 @@ def main():
         additional_params.update({'excluded_namespaces': excluded_namespaces})
     
 
+    # Get Env Variable for number of concurrent namespace stats requests
+    NS_FETCH_WORKERS = os.getenv('NS_FETCH_WORKERS')
+
+    if NS_FETCH_WORKERS:
+        additional_params.update({'fetch_workers': int(NS_FETCH_WORKERS)})
+
+    # Get Env Variable for number of namespaces to request stats for in a single call
+    NS_STATS_BATCH_SIZE = os.getenv('NS_STATS_BATCH_SIZE')
+
+    if NS_STATS_BATCH_SIZE:
+        additional_params.update({'stats_batch_size': int(NS_STATS_BATCH_SIZE)})
+
+    # Get Env Variables for the persistent response cache
+    NS_CACHE_PATH = os.getenv('NS_CACHE_PATH')
+    NS_CACHE_TTL = os.getenv('NS_CACHE_TTL')
+    NS_CACHE_MAX_MB = os.getenv('NS_CACHE_MAX_MB')
+
+    if NS_CACHE_PATH:
+        cache_params = {'path': NS_CACHE_PATH,
+                        'ttl': int(NS_CACHE_TTL) if NS_CACHE_TTL else 86400,
+                        'max_size': int(NS_CACHE_MAX_MB)*1024*1024 if NS_CACHE_MAX_MB else 512*1024*1024}
+    else:
+        cache_params = None
+
+    # Get Env Variables for the incremental daily aggregate store
+    NS_MODE = os.getenv('NS_MODE', 'report').lower()
+    NS_AGGREGATE_PATH = os.getenv('NS_AGGREGATE_PATH')
+    NS_AGGREGATE_RETENTION_DAYS = os.getenv('NS_AGGREGATE_RETENTION_DAYS')
+    NS_DAILY_DATE = os.getenv('NS_DAILY_DATE')
+
+    if NS_AGGREGATE_PATH:
+        aggregate_params = {'path': NS_AGGREGATE_PATH,
+                            'retention_days': int(NS_AGGREGATE_RETENTION_DAYS) if NS_AGGREGATE_RETENTION_DAYS else 93}
+    else:
+        aggregate_params = None
+
+    if NS_MODE == 'daily':
+        if not NS_AGGREGATE_PATH:
+            umsg.log("NS_AGGREGATE_PATH is required when NS_MODE is daily", level=logging.ERROR)
+            sys.exit(1)
+
+        if NS_DAILY_DATE:
+            daily_date = datetime.date.fromisoformat(NS_DAILY_DATE)
+        else:
+            daily_date = datetime.date.today() - datetime.timedelta(days=1)
+        start_date, end_date = NamespaceTopology.get_start_end_day(daily_date)
+        additional_params.update({'start_date': start_date, 'end_date': end_date})
+
     # Get Env Variable for Master Node Group of Nodes to Exclude
     EXCLUDE_MASTER = os.getenv('EXCLUDE_MASTER')
 
     if EXCLUDE_MASTER:
         exclude_master = list(EXCLUDE_MASTER.split(':'))
         additional_params.update({'exclude_master': exclude_master})
-    
 
+    # Get Env Variables for the run summary and Prometheus textfile
+    NS_RUN_SUMMARY = os.getenv('NS_RUN_SUMMARY')
+    NS_METRICS_PROM_FILE = os.getenv('NS_METRICS_PROM_FILE')
+
+    run_metrics = RunMetrics()
+    additional_params.update({'run_metrics': run_metrics})
+
+    # Get Env Variables for the API rate limiter and retries
+    NS_RATE_LIMIT = os.getenv('NS_RATE_LIMIT')
+    NS_RATE_LIMIT_MAX = os.getenv('NS_RATE_LIMIT_MAX')
+    NS_TARGET_LATENCY = os.getenv('NS_TARGET_LATENCY')
+    NS_MAX_RETRIES = os.getenv('NS_MAX_RETRIES')
+
+    limiter_params = {'rate': float(NS_RATE_LIMIT) if NS_RATE_LIMIT else None,
+                      'max_rate': float(NS_RATE_LIMIT_MAX) if NS_RATE_LIMIT_MAX else None,
+                      'target_latency': float(NS_TARGET_LATENCY) if NS_TARGET_LATENCY else 2.0,
+                      'max_retries': int(NS_MAX_RETRIES) if NS_MAX_RETRIES else 5}
+
+    # Get Env Variables for the page size of paged requests
+    NS_PAGE_SIZE = os.getenv('NS_PAGE_SIZE')
+    NS_PAGE_SIZE_ADAPTIVE = os.getenv('NS_PAGE_SIZE_ADAPTIVE', 'False').lower() in ('true', '1', 't')
+    NS_PAGE_SIZE_MAX = os.getenv('NS_PAGE_SIZE_MAX')
+    NS_PAGE_TARGET_SECONDS = os.getenv('NS_PAGE_TARGET_SECONDS')
+
+    if NS_PAGE_SIZE or NS_PAGE_SIZE_ADAPTIVE:
+        pager_params = {'sizes': PageSizer.parse_sizes(NS_PAGE_SIZE),
+                        'adaptive': NS_PAGE_SIZE_ADAPTIVE,
+                        'max_size': int(NS_PAGE_SIZE_MAX) if NS_PAGE_SIZE_MAX else 500,
+                        'target_latency': float(NS_PAGE_TARGET_SECONDS) if NS_PAGE_TARGET_SECONDS else 5.0}
+    else:
+        pager_params = None
+
+    # Get Env Variables for reporting on several Turbonomic instances
+    instances = get_instances()
+    NS_INSTANCE_TIMEOUT = os.getenv('NS_INSTANCE_TIMEOUT')
+
+    # Get Env Variables for sharded execution, JOB_COMPLETION_INDEX is set on the pods of a Kubernetes Indexed Job
+    NS_SHARD_COUNT = os.getenv('NS_SHARD_COUNT')
+    NS_SHARD_INDEX = os.getenv('NS_SHARD_INDEX', os.getenv('JOB_COMPLETION_INDEX'))
+    NS_PARTIAL_PATH = os.getenv('NS_PARTIAL_PATH')
+    NS_MERGE_TIMEOUT = os.getenv('NS_MERGE_TIMEOUT')
+
+    if NS_MODE in ('shard', 'merge'):
+        if not (NS_SHARD_COUNT and NS_PARTIAL_PATH):
+            umsg.log(f"NS_SHARD_COUNT and NS_PARTIAL_PATH are required when NS_MODE is {NS_MODE}", level=logging.ERROR)
+            sys.exit(1)
+        shard_partials = shard_partial_paths(NS_PARTIAL_PATH, int(NS_SHARD_COUNT))
+
+    # Get Env Variable for the report windows
+    NS_WINDOWS = os.getenv('NS_WINDOWS')
+
+    if NS_WINDOWS:
+        if NS_MODE != 'report' or instances or NS_AGGREGATE_PATH:
+            umsg.log("NS_WINDOWS is only supported for reports on a single Turbonomic instance without NS_AGGREGATE_PATH", level=logging.ERROR)
+            sys.exit(1)
+        try:
+            additional_params.update({'windows': ReportWindow.parse(NS_WINDOWS)})
+        except ValueError:
+            umsg.log(error_handling(), level=logging.ERROR)
+            sys.exit(1)
+
+    # Get Env Variables for the run history used for month over month changes
+    NS_HISTORY_PATH = os.getenv('NS_HISTORY_PATH')
+    NS_HISTORY_RETENTION = os.getenv('NS_HISTORY_RETENTION')
+    NS_DELTA_METRICS = os.getenv('NS_DELTA_METRICS')
+    NS_TOP_GROWTH = os.getenv('NS_TOP_GROWTH')
+
+    if NS_HISTORY_PATH:
+        if NS_MODE != 'report' or instances or NS_WINDOWS:
+            umsg.log("NS_HISTORY_PATH is only supported for reports on a single Turbonomic instance without NS_WINDOWS", level=logging.ERROR)
+            sys.exit(1)
+        delta_metrics = list(NS_DELTA_METRICS.split(':')) if NS_DELTA_METRICS else ['average']
+        if any(metric.lower() not in SUPPORTED_METRICS for metric in delta_metrics):
+            umsg.log(f"Unsupported NS_DELTA_METRICS {delta_metrics}, valid options are {SUPPORTED_METRICS}", level=logging.ERROR)
+            sys.exit(1)
+        history_params = {'path': NS_HISTORY_PATH,
+                          'retention': int(NS_HISTORY_RETENTION) if NS_HISTORY_RETENTION else 13}
+        additional_params.update({'delta_metrics': delta_metrics,
+                                  'top_growth': int(NS_TOP_GROWTH) if NS_TOP_GROWTH else 20})
+    else:
+        history_params = None
+
+    # Get Env Variables for the service mode
+    NS_SERVICE_PORT = os.getenv('NS_SERVICE_PORT')
+    NS_SERVICE_REFRESH = os.getenv('NS_SERVICE_REFRESH')
 
+    if NS_MODE == 'service' and (instances or NS_AGGREGATE_PATH):
+        umsg.log("NS_MODE service is only supported on a single Turbonomic instance without NS_AGGREGATE_PATH", level=logging.ERROR)
+        sys.exit(1)
+
+    if NS_MODE == 'shard':
+        if NS_SHARD_INDEX is None or not 0 <= int(NS_SHARD_INDEX) < int(NS_SHARD_COUNT):
+            umsg.log(f"NS_SHARD_INDEX or JOB_COMPLETION_INDEX must be between 0 and {int(NS_SHARD_COUNT) - 1}", level=logging.ERROR)
+            sys.exit(1)
+        additional_params.update({'shard_index': int(NS_SHARD_INDEX), 'shard_count': int(NS_SHARD_COUNT)})
 
-    # Create Connection object to Turbonomic
-    vmt = vc.Connection(host=TURBO_HOST,username=TURBO_USER, password=TURBO_PASS)
-    
-    # Create NamespaceTopology Object
-    ns_Top = NamespaceTopology(vmt, commodities=commodities, metrics=metrics, tags=tags, **additional_params)   
 
     # Output NamespaceTopology to CSV
     NS_FILETYPE = os.getenv('NS_FILETYPE','csv')
+
+    if NS_FILETYPE.lower() == 'parquet' and pa is None:
+        umsg.log("NS_FILETYPE parquet requires the pyarrow package", level=logging.ERROR)
+        sys.exit(1)
+
+    # Get Env Variables for delivering the report
+    NS_COMPRESS_ATTACHMENTS = os.getenv('NS_COMPRESS_ATTACHMENTS', 'True').lower() in ('true', '1', 't')
+    NS_MAX_EMAIL_MB = os.getenv('NS_MAX_EMAIL_MB', '10')
+    NS_S3_BUCKET = os.getenv('NS_S3_BUCKET')
+    NS_S3_URL_EXPIRY = os.getenv('NS_S3_URL_EXPIRY', '604800')
+
+    if NS_S3_BUCKET and boto3 is None:
+        umsg.log("NS_S3_BUCKET requires the boto3 package", level=logging.ERROR)
+        sys.exit(1)
+
+    delivery_params = {'filetype': NS_FILETYPE,
+                       'compress': NS_COMPRESS_ATTACHMENTS,
+                       'max_email_mb': float(NS_MAX_EMAIL_MB) if NS_MAX_EMAIL_MB else None,
+                       'bucket': NS_S3_BUCKET,
+                       'endpoint': os.getenv('NS_S3_ENDPOINT'),
+                       'prefix': os.getenv('NS_S3_PREFIX', ''),
+                       'access_key': os.getenv('NS_S3_ACCESS_KEY'),
+                       'secret_key': os.getenv('NS_S3_SECRET_KEY'),
+                       'region': os.getenv('NS_S3_REGION'),
+                       'url_expiry': int(NS_S3_URL_EXPIRY)}
+
     # NS_FILENAME = os.getenv('NS_FILENAME',f"namespaceReport.{NS_FILETYPE.lower()}")
     NS_FILENAME = os.getenv(f'NS_FILENAME_{datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d")}.{NS_FILETYPE.lower()}',
         f'namespaceReport_{datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d")}.{NS_FILETYPE.lower()}')
 
     ns_filepath = '/tmp/'
     ns_file_output = os.path.join(ns_filepath, NS_FILENAME)
-    
+    page_sizer = None
 
-    try:
-        if NS_FILENAME.lower() == 'xlsx':
-            ns_Top.output_to_xlsx(ns_file_output)
-        else:
-            ns_Top.output_to_csv(ns_file_output)
-    except OSError:
-        umsg.log(error_handling(), level=logging.ERROR)
-        umsg.log(f"Cannot save to file {ns_file_output}", level=logging.ERROR)
+    # A shard writes its rows to a partial result which is merged into the report by the merge step
+    if NS_MODE == 'shard':
+        report_output, report_filetype = shard_partials[int(NS_SHARD_INDEX)], 'jsonl'
+    else:
+        report_output, report_filetype = ns_file_output, NS_FILETYPE
+    report_files = [ns_file_output]
+
+    if NS_MODE == 'merge':
+        missing = wait_for_partials(shard_partials, timeout=float(NS_MERGE_TIMEOUT) if NS_MERGE_TIMEOUT else 0)
+
+        if missing:
+            umsg.log(f"Missing partial result(s) {missing}, not sending a report", level=logging.ERROR)
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            sys.exit(1)
+
+        try:
+            with run_metrics.phase('output'):
+                NamespaceTopology.merge_partials(shard_partials, ns_file_output, NS_FILETYPE)
+        except OSError:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot save to file {ns_file_output}, keeping the partial results {shard_partials}", level=logging.ERROR)
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            sys.exit(1)
+
+        # Partial results are only removed once they are merged
+        for partial in shard_partials:
+            os.remove(partial)
+
+    elif instances:
+        # Collect each instance in its own process and merge the partial results into one report
+        config = {'mode': NS_MODE,
+                  'topology': dict(additional_params, commodities=commodities, metrics=metrics, tags=tags, run_metrics=None),
+                  'limiter': limiter_params,
+                  'pager': pager_params,
+                  'cache': cache_params,
+                  'aggregate': aggregate_params}
+        partials = collect_instances(instances, config, ns_filepath, run_metrics,
+                                     timeout=float(NS_INSTANCE_TIMEOUT) if NS_INSTANCE_TIMEOUT else None)
+
+        if NS_MODE == 'daily':
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            return
+
+        if not partials:
+            umsg.log("No instance could be collected, not sending a report", level=logging.ERROR)
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            sys.exit(1)
+
+        try:
+            with run_metrics.phase('output'):
+                NamespaceTopology.merge_partials(partials, report_output, report_filetype)
+        except OSError:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot save to file {report_output}, keeping the partial results {partials}", level=logging.ERROR)
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            sys.exit(1)
+
+        # Partial results are only removed once they are merged
+        for partial in partials:
+            os.remove(partial)
+
+    else:
+        cache = ResponseCache(**cache_params) if cache_params else None
+        aggregate_store = AggregateStore(**aggregate_params) if aggregate_params else None
+        history = RunHistoryStore(**history_params) if history_params else None
+
+        if cache:
+            additional_params.update({'cache': cache})
+        if history:
+            additional_params.update({'history': history})
+        if aggregate_store and NS_MODE != 'daily':
+            additional_params.update({'aggregate_store': aggregate_store})
+
+        # Create Connection object to Turbonomic
+        vmt, page_sizer = create_connection(TURBO_HOST, TURBO_USER, TURBO_PASS, run_metrics, limiter_params, pager_params)
+
+        # Serve reports from a warm topology, keeping every tag so requests can choose the tag columns
+        if NS_MODE == 'service':
+            ns_Top = NamespaceTopology(vmt, commodities=commodities, metrics=metrics, **additional_params)
+            service = ReportService(ns_Top, tags=tags,
+                                    refresh_interval=float(NS_SERVICE_REFRESH) if NS_SERVICE_REFRESH else 900,
+                                    port=int(NS_SERVICE_PORT) if NS_SERVICE_PORT else 8080)
+            service.serve_forever()
+            return
+
+        # Create NamespaceTopology Object
+        ns_Top = NamespaceTopology(vmt, commodities=commodities, metrics=metrics, tags=tags, **additional_params)
+
+        # Daily collection only updates the aggregate store
+        if NS_MODE == 'daily':
+            ns_Top.store_daily_stats(aggregate_store)
+            aggregate_store.close()
+            if cache:
+                cache.close()
+            if page_sizer:
+                page_sizer.log_summary()
+            write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+            return
+
+        try:
+            with run_metrics.phase('output'):
+                report_files = ns_Top.output_to_file(report_output, report_filetype)
+        except OSError:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot save to file {report_output}", level=logging.ERROR)
+
+        if cache:
+            cache.close()
+        if history:
+            history.close()
+
+    # Shards leave emailing the report to the merge step
+    if NS_MODE == 'shard':
+        if page_sizer:
+            page_sizer.log_summary()
+        write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
+        return
 
     NS_SMTP_SERVER = os.getenv('NS_SMTP_SERVER')
     NS_SMTP_PORT = os.getenv('NS_SMTP_PORT')
@@ -535,18 +2913,48 @@ def main():
         tls = False
 
     to_addrs = list(NS_TO_ADDRS.split(':'))
-    
-    sendemail = sendmail(subject=NS_SUBJECT, from_addr=NS_FROM_ADDRS, to_addr=to_addrs, smtp_addr=NS_SMTP_SERVER, smtp_port=smtp_port,tls=tls)
+    delivery = ReportDelivery(**delivery_params)
+    body = NS_BODY
+    emails = None
+
+    # Upload the report and email links to it, falling back to attachments if the upload fails
+    if delivery.bucket:
+        try:
+            with run_metrics.phase('upload'):
+                links = delivery.upload(report_files)
+            expiry = datetime.datetime.now() + datetime.timedelta(seconds=delivery.url_expiry)
+            body = '\n\n'.join(filter(None, [NS_BODY, f"The report is available until {expiry.strftime('%Y-%m-%d %H:%M')} at:",
+                                                 '\n'.join(links)]))
+            emails = [[]]
+        except Exception:
+            umsg.log(error_handling(), level=logging.ERROR)
+            umsg.log(f"Cannot upload to bucket {delivery.bucket}, attaching the report instead", level=logging.ERROR)
+
+    if emails is None:
+        with run_metrics.phase('attachments'):
+            emails = delivery.get_emails(report_files)
+
+    for part, attachments in enumerate(emails, 1):
+        subject = f'{NS_SUBJECT} ({part} of {len(emails)})' if len(emails) > 1 else NS_SUBJECT
+        sendemail = sendmail(subject=subject, from_addr=NS_FROM_ADDRS, to_addr=to_addrs, smtp_addr=NS_SMTP_SERVER, smtp_port=smtp_port,tls=tls)
+
+        if body:
+            sendemail.add_body(body)
+
+        if NS_AUTH:
+            sendemail.add_auth(username=NS_USERNAME, password=NS_PASSWORD)
 
-    if NS_BODY:
-        sendemail.add_body(NS_BODY)
+        if attachments:
+            sendemail.add_attachments(attachments)
+        umsg.log(f'Emailing file(s) {attachments} to {to_addrs}' if attachments else f'Emailing report links to {to_addrs}')
+        with run_metrics.phase('email'):
+            sendemail.sendmail()
 
-    if NS_AUTH:
-        sendemail.add_auth(username=NS_USERNAME, password=NS_PASSWORD)
+    delivery.cleanup()
 
-    sendemail.add_attachments([ns_file_output])
-    umsg.log(f'Emailing file {ns_file_output} to {to_addrs}')
-    sendemail.sendmail()
+    if page_sizer:
+        page_sizer.log_summary()
+    write_run_metrics(run_metrics, NS_RUN_SUMMARY, NS_METRICS_PROM_FILE)
     
 
 if __name__ == '__main__':
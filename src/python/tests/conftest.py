@@ -0,0 +1,45 @@
+"""Fixtures for the namespace-util tests, run against the synthetic Turbonomic stand-in
+
+namespace-util.py is imported as in the benchmark tools, so the packages from the Dockerfile
+and sendmail.py must be available.
+"""
+import os
+import sys
+import warnings
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmark'))
+
+from nsutil import load_namespace_util
+from turbo_standin import StandinServer, SyntheticTopology
+
+
+@pytest.fixture(scope='session')
+def nsu():
+    return load_namespace_util()
+
+
+@pytest.fixture(scope='session')
+def standin():
+    server = StandinServer(SyntheticTopology(clusters=3, nodes=4, namespaces=30, days=75, system_namespaces=0.1)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def connect(nsu, standin):
+    """Return a function opening a new connection to the stand-in"""
+    def connect():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return nsu.vc.Connection(standin.host, 'x', 'x', ssl=False)
+    return connect
+
+
+@pytest.fixture
+def report_rows(nsu, connect):
+    """Return a function building a NamespaceTopology and returning its headers and rows"""
+    def report_rows(**kwargs):
+        return list(nsu.NamespaceTopology(connect(), **kwargs).output_rows())
+    return report_rows
@@ -0,0 +1,41 @@
+"""Tests of report filetypes that need optional packages"""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+
+def test_parquet_without_pyarrow_fails_before_collecting(nsu, standin, monkeypatch):
+    monkeypatch.setattr(nsu, 'pa', None)
+    monkeypatch.setenv('TURBO_HOST', standin.host)
+    monkeypatch.setenv('NS_FILETYPE', 'parquet')
+    requests = standin.counters['requests']
+
+    with pytest.raises(SystemExit) as exit_info:
+        nsu.main()
+
+    assert exit_info.value.code == 1
+    assert standin.counters['requests'] == requests
+
+
+def test_service_rejects_parquet_without_pyarrow(nsu, monkeypatch):
+    monkeypatch.setattr(nsu, 'pa', None)
+    # The topology is never refreshed, so the service is not ready
+    service = nsu.ReportService(None, host='127.0.0.1', port=0)
+    threading.Thread(target=service._httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{service._httpd.server_address[1]}/report'
+
+    try:
+        with pytest.raises(urllib.error.HTTPError) as parquet:
+            urllib.request.urlopen(f'{url}?format=parquet')
+        with pytest.raises(urllib.error.HTTPError) as csv:
+            urllib.request.urlopen(f'{url}?format=csv')
+    finally:
+        service._httpd.shutdown()
+        service._httpd.server_close()
+
+    assert parquet.value.code == 400
+    assert 'pyarrow' in json.loads(parquet.value.read())['error']
+    assert csv.value.code == 503
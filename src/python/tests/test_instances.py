@@ -0,0 +1,35 @@
+"""Tests of collecting instances in worker processes"""
+import functools
+import threading
+import time
+
+from turbo_standin import StandinServer, SyntheticTopology
+
+
+def test_timed_out_instance_leaves_no_files(nsu, tmp_path, monkeypatch):
+    server = StandinServer(SyntheticTopology(clusters=1, nodes=2, namespaces=30, days=40)).start()
+    monkeypatch.setattr(nsu.vc, 'Connection', functools.partial(nsu.vc.Connection, ssl=False))
+    stalled = threading.Event()
+
+    def stall_once_writing():
+        # Hold every request once the worker has opened its temporary output
+        while not stalled.is_set():
+            if list(tmp_path.glob('*.tmp')):
+                server.latency = 60
+                stalled.set()
+            time.sleep(0.01)
+
+    watcher = threading.Thread(target=stall_once_writing, daemon=True)
+    watcher.start()
+    config = {'mode': 'monthly', 'topology': {'run_metrics': None}, 'limiter': {}, 'pager': None, 'cache': None, 'aggregate': None}
+    run_metrics = nsu.RunMetrics()
+    try:
+        partials = nsu.collect_instances([{'name': 'slow', 'host': server.host, 'username': 'x', 'password': 'x'}],
+                                         config, str(tmp_path), run_metrics, timeout=5)
+    finally:
+        stalled.set()
+        server.stop()
+
+    assert partials == []
+    assert 'timed out' in run_metrics.instances['slow']['error']
+    assert list(tmp_path.iterdir()) == []